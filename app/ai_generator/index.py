@@ -1,14 +1,20 @@
-import json
+import functools
+import itertools
 import logging
 import os
 import random
 import re
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from decimal import Decimal, InvalidOperation
-from io import BytesIO
+from decimal import Decimal
+from urllib.parse import unquote_plus
 
 import boto3
+import orjson
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from fpdf import FPDF
 
@@ -16,43 +22,192 @@ from fpdf import FPDF
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Keep the connections of the cached clients alive between warm invocations and fail fast when
+# an endpoint can't be reached. The pool is sized for the findings of an SQS batch being
+# processed concurrently
+CONNECTION_CONFIG = Config(
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=5,
+    max_pool_connections=20,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+# Let the SDK absorb throttling with exponential backoff and client side rate limiting, so
+# schedule_retry is only used once the retry budget of a call is exhausted
+RETRY_CONFIG = CONNECTION_CONFIG.merge(Config(retries={"max_attempts": 3, "mode": "adaptive"}))
+# Bedrock only answers once the insights are generated, the read timeout leaves it the time to
+# generate up to max_tokens
+BEDROCK_CONFIG = CONNECTION_CONFIG.merge(
+    Config(read_timeout=90, retries={"max_attempts": 2, "mode": "adaptive"})
+)
+# The worst case of the sequential calls of a finding, attempts * (connect + read timeout), stays
+# under the 5 minutes timeout of the function: Detective graph and members 2 * 21s, Bedrock
+# 184s, the S3 upload and the SNS publish of the batch 21s each
+CLIENT_CONFIGS = {
+    "bedrock-runtime": BEDROCK_CONFIG,
+    "detective": RETRY_CONFIG,
+    "guardduty": RETRY_CONFIG,
+    "s3": CONNECTION_CONFIG,
+    "scheduler": CONNECTION_CONFIG,
+    "sns": CONNECTION_CONFIG,
+}
+# Timeout of the function in the AISecurityRecommendations stack
+FUNCTION_TIMEOUT_SECONDS = 300
+
+# The AI insights are stored under this prefix, which triggers the PDF generation function
+INSIGHTS_PREFIX = "insights/"
+
+# Incoming events are logged for troubleshooting, capped to keep the log records small
+MAX_LOGGED_EVENT_LENGTH = 2000
+
+# Delays used when rescheduling the invocation, EventBridge schedules have minute granularity
+RETRY_BASE_DELAY_SECONDS = 60
+RETRY_MAX_DELAY_SECONDS = 600
+RETRY_DETAIL_KEYS = ("schemaVersion", "accountId", "region", "partition", "id")
+
+# Sections of the AI insights are separated by blank lines, headers are rendered in bold
+INSIGHTS_SECTION_SPLIT = re.compile(r"\n\s*\n")
+INSIGHTS_H3_HEADERS = frozenset({"Analysis:", "Remediation Actions:", "Recommended Actions:"})
+INSIGHTS_H4_HEADERS = frozenset({"Entities Involved:", "Security Group Impact:", "Attempt Status:"})
+
+# Only these fields of the Detective members are relevant to the analysis, the rest of the
+# member details just inflate the prompt
+DETECTIVE_ENTITY_FIELDS = (
+    "AccountId",
+    "EmailAddress",
+    "Status",
+    "DisabledReason",
+    "InvitedTime",
+    "UpdatedTime",
+)
+
+# Upper bound of Detective members included in the prompt, larger graphs only add tokens
+MAX_DETECTIVE_ENTITIES = 100
+
+# Static content of the PDF report
+GUARDDUTY_FINDING_LINK = (
+    "https://{region}.console.aws.amazon.com/guardduty/home?region={region}#/findings?"
+    "search=id%3D{finding_id}&macros=current"
+)
+DETECTIVE_FINDING_LINK = (
+    "https://{region}.console.aws.amazon.com/detective/home?region={region}#search?"
+    "searchType=Finding&searchText={finding_id}"
+)
+REPORT_SUMMARY_TEXT = (
+    "The above insights and recommendations provide detailed information on mitigating the"
+    " identified threat. Please ensure the recommended security actions are promptly applied to"
+    " minimize future risks."
+)
+
+# The SNS message structure only depends on the pre-signed URL, so it is serialized once
+SNS_SUBJECT = "GuardDuty Finding Enrichment Report"
+SNS_MESSAGE_TEMPLATE = orjson.dumps(
+    {
+        "default": "New GuardDuty finding with enriched PDF. Click the link to download.",
+        "email": (
+            "New GuardDuty finding. Enriched PDF with AI remediation's can be downloaded here: "
+            "{url}"
+        ),
+    }
+).decode()
 
-def convert_to_json_serializable(data):
-    """Recursively convert Decimal and other non-serializable types to JSON-compatible types."""
-    if isinstance(data, dict):
-        return {key: convert_to_json_serializable(value) for key, value in data.items()}
-    elif isinstance(data, list):
-        return [convert_to_json_serializable(item) for item in data]
-    elif isinstance(data, Decimal):
-        return float(data)  # Convert Decimal to float for JSON serialization
-    elif isinstance(data, datetime):
-        return data.isoformat()  # Convert datetime to an ISO 8601 formatted string
-    else:
-        return data  # Return as is
-
-
-def convert_to_string(data):
-    """Recursively convert float values in a dictionary to string."""
-    if isinstance(data, dict):
-        return {key: convert_to_string(value) for key, value in data.items()}
-    elif isinstance(data, list):
-        return [convert_to_string(item) for item in data]
-    elif isinstance(data, float):
-        try:
-            return str(data)  # Convert float to string
-        except InvalidOperation:
-            return "0"  # Fallback to zero or another default value as a string
-    else:
-        return data  # Return as is
+# Detective graph ARNs are stable per account and region, so they are cached for an hour
+GRAPH_ARN_CACHE_TTL_SECONDS = 3600
+_graph_arns = {}
+
+# Findings and Detective members are cached briefly, so duplicate deliveries of the same finding
+# to a warm container don't repeat the lookups
+LOOKUP_CACHE_TTL_SECONDS = 60
+LOOKUP_CACHE_MAX_SIZE = 128
+_findings = {}
+_detective_entities = {}
+# The lookups run in the threads of a batch, the eviction from a full cache is done under a lock
+_caches_lock = threading.Lock()
+
+# Whether the reports topic has confirmed subscriptions, checked again every five minutes
+SUBSCRIPTIONS_CACHE_TTL_SECONDS = 300
+_topic_subscriptions = {}
+
+# The findings of an SQS batch are processed concurrently, SNS publishes up to 10 per call
+MAX_BATCH_WORKERS = 10
+SNS_PUBLISH_BATCH_SIZE = 10
+
+# boto3 clients are cached so warm invocations of the container reuse them, they are created
+# under a lock since the default session isn't thread safe
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name: str):
+    """Return the cached boto3 client for a service, creating it on first use."""
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = _clients[service_name] = boto3.client(
+                    service_name, config=CLIENT_CONFIGS.get(service_name)
+                )
+    return client
+
+
+def _reset_clients():
+    """Drop all cached boto3 clients."""
+    _clients.clear()
+
+
+def _reset_caches():
+    """Drop all cached AWS lookups."""
+    _graph_arns.clear()
+    _findings.clear()
+    _detective_entities.clear()
+    _topic_subscriptions.clear()
+    get_extra_body_args.cache_clear()
+
+
+def _get_cached(cache: dict, key):
+    """Return the cached value of a key, or None if it is missing or expired."""
+    cached = cache.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def _set_cached(cache: dict, key, value, ttl: float):
+    """Cache a value for ttl seconds, evicting the oldest entry once the cache is full."""
+    with _caches_lock:
+        cache.pop(key, None)
+        if len(cache) >= LOOKUP_CACHE_MAX_SIZE:
+            cache.pop(next(iter(cache), None), None)
+        cache[key] = (value, time.monotonic() + ttl)
+
+
+def json_default(data):
+    """Serialize the types orjson does not support natively, such as Decimal."""
+    if isinstance(data, Decimal):
+        return float(data)
+    return str(data)
+
+
+JSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+
+def to_json(data) -> str:
+    """Serialize data to a compact JSON string, datetimes are rendered as ISO 8601 UTC."""
+    return orjson.dumps(data, default=json_default, option=JSON_OPTIONS).decode()
 
 
 def get_guardduty_finding(client: boto3.client, detector_id: str, finding_id: str):
-    """Retrieve details of a GuardDuty finding."""
+    """Retrieve details of a GuardDuty finding, cached briefly on warm invocations."""
+    finding = _get_cached(_findings, (detector_id, finding_id))
+    if finding is not None:
+        return finding
     try:
         finding = client.get_findings(DetectorId=detector_id, FindingIds=[finding_id])["Findings"][
             0
         ]
         logger.info("Successfully retrieved GuardDuty finding details")
+        _set_cached(_findings, (detector_id, finding_id), finding, LOOKUP_CACHE_TTL_SECONDS)
         return finding
     except Exception as e:
         logger.error("Error retrieving GuardDuty finding: %s", e)
@@ -60,80 +215,113 @@ def get_guardduty_finding(client: boto3.client, detector_id: str, finding_id: st
 
 
 def get_graph_arn(client: boto3.client):
-    """Retrieve the graph ARN for Amazon Detective."""
+    """Retrieve the graph ARN for Amazon Detective, cached per region on warm invocations."""
+    region = client.meta.region_name
+    graph_arn = _get_cached(_graph_arns, region)
+    if graph_arn is not None:
+        return graph_arn
     try:
         graphs = client.list_graphs()
         if not graphs.get("GraphList", []):
             raise Exception("No graphs found in Amazon Detective.")
         graph_arn = graphs["GraphList"][0]["Arn"]
         logger.info("Retrieved Amazon Detective graph ARN: %s", graph_arn)
+        _set_cached(_graph_arns, region, graph_arn, GRAPH_ARN_CACHE_TTL_SECONDS)
         return graph_arn
     except Exception as e:
         logger.error("Error retrieving Amazon Detective graph ARN: %s", e)
         raise
 
 
-def get_entity_details(client: boto3.client, graph_arn: str, account_id: str):
-    """Retrieve entity details from Amazon Detective."""
-    try:
-        entity_data = client.get_members(GraphArn=graph_arn, AccountIds=[account_id])
-        entity_details = entity_data["MemberDetails"][0]
-        logger.info("Successfully retrieved entity details from Amazon Detective")
-        return entity_details
-    except Exception as e:
-        logger.error("Error retrieving entity details from Detective: %s", e)
-        raise
-
-
-def list_datasource_packages(client: boto3.client, graph_arn):
-    """List data source packages in Detective."""
-    try:
-        response = client.list_datasource_packages(GraphArn=graph_arn)
-        logger.info("Successfully retrieved datasource packages from Amazon Detective")
-        return response["DatasourcePackages"]
-    except Exception as e:
-        logger.error(f"Error retrieving data source packages: {e}")
-        return None
+def iter_detective_members(client: boto3.client, graph_arn: str):
+    """Yield the members of a Detective graph, requesting the next page only when needed."""
+    kwargs = {"GraphArn": graph_arn}
+    while True:
+        response = client.list_members(**kwargs)
+        yield from response.get("MemberDetails", [])
+        next_token = response.get("NextToken")
+        if not next_token:
+            return
+        kwargs["NextToken"] = next_token
 
 
 def get_all_detective_entities(client: boto3.client, graph_arn: str) -> list:
     """
-    Retrieve all entity details from Amazon Detective.
+    Retrieve all entity details from Amazon Detective, cached briefly on warm invocations.
 
     Args:
         client (boto3.client): The boto3 Detective client.
         graph_arn (str): The ARN of the Detective graph.
 
     Returns:
-        list: A list of member details.
+        list: A list of up to MAX_DETECTIVE_ENTITIES member details.
 
     Raises:
         ClientError: If there's an issue with the AWS API call.
         Exception: For any other unexpected errors.
     """
+    all_members = _get_cached(_detective_entities, graph_arn)
+    if all_members is not None:
+        return all_members
     try:
-        # Call list_members directly since it's not paginated
-        response = client.list_members(GraphArn=graph_arn)
-        all_members = response.get("MemberDetails", [])
+        # Stop paginating once enough members for the prompt were retrieved
+        all_members = list(
+            itertools.islice(iter_detective_members(client, graph_arn), MAX_DETECTIVE_ENTITIES)
+        )
 
         logger.info(
-            f"Successfully retrieved {len(all_members)} entity details from Amazon Detective"
+            "Successfully retrieved %d entity details from Amazon Detective", len(all_members)
         )
+        _set_cached(_detective_entities, graph_arn, all_members, LOOKUP_CACHE_TTL_SECONDS)
         return all_members
 
     except ClientError as e:
         error_code = e.response["Error"]["Code"]
         error_message = e.response["Error"]["Message"]
         logger.error(
-            f"AWS API error when retrieving entities from Detective: {error_code} - {error_message}"
+            "AWS API error when retrieving entities from Detective: %s - %s",
+            error_code,
+            error_message,
         )
         raise
 
     except Exception as e:
-        logger.error(f"Unexpected error retrieving entities from Detective: {str(e)}")
+        logger.error("Unexpected error retrieving entities from Detective: %s", e)
         raise
 
 
+@functools.lru_cache(maxsize=None)
+def get_extra_body_args() -> dict:
+    """Read the additional Bedrock body arguments from the body_args_* environment variables.
+
+    The environment does not change during the lifetime of a Lambda container, so the
+    variables are only scanned and parsed once.
+    """
+    extra_body_args = {}
+    for key, value in os.environ.items():
+        if key.startswith("body_args_"):
+            arg_name = key[10:]  # Remove 'body_args_' prefix
+            # Try to parse the value as JSON, if it fails, use the string value
+            try:
+                extra_body_args[arg_name] = orjson.loads(value)
+            except orjson.JSONDecodeError:
+                extra_body_args[arg_name] = value
+    return extra_body_args
+
+
+def get_detective_entities(client: boto3.client) -> list:
+    """Retrieve all entity details of the Amazon Detective graph of the region."""
+    return get_all_detective_entities(client, get_graph_arn(client))
+
+
+def slim_detective_entities(detective_entities: list) -> list:
+    """Project the Detective members to the fields included in the prompt."""
+    return [
+        {key: entity[key] for key in DETECTIVE_ENTITY_FIELDS if key in entity}
+        for entity in detective_entities
+    ]
+
+
 def invoke_bedrock_model(
     client: boto3.client, finding: dict, detective_entities: dict, event: dict, context: dict
 ):
@@ -146,9 +334,9 @@ def invoke_bedrock_model(
                     "You are a cybersecurity assistant that specializes in providing actionable"
                     " solutions for security threats detected by AWS services. Here is the"
                     " GuardDuty finding and relevant enrichment data from Amazon Detective:"
-                    f" {json.dumps(finding, indent=4)}. "
+                    f" {to_json(finding)}. "
                     f"Detective entities involved:"
-                    f" {json.dumps(detective_entities, indent=4)}. "
+                    f" {to_json(slim_detective_entities(detective_entities))}. "
                     "Based on this information,determine if this was a successful breach or a blocked attempt. Also,"
                     " provide information on the entities involved and if a security group is"
                     " impacted and needs intervention.Also, provide specific actions I should take"
@@ -157,7 +345,7 @@ def invoke_bedrock_model(
                 ),
             }
         ]
-        model_id = os.environ.get('BEDROCK_MODEL_ID', 'anthropic.claude-3-5-sonnet-20240620-v1:0')
+        model_id = os.environ["BEDROCK_MODEL_ID"]
         # Construct body arguments
         body_args = {
             "messages": messages,
@@ -166,24 +354,22 @@ def invoke_bedrock_model(
         }
 
         # Add additional body arguments from environment variables
-        for key, value in os.environ.items():
-            if key.startswith('body_args_'):
-                arg_name = key[10:]  # Remove 'body_args_' prefix
-                # Try to parse the value as JSON, if it fails, use the string value
-                try:
-                    body_args[arg_name] = json.loads(value)
-                except json.JSONDecodeError:
-                    body_args[arg_name] = value
-        logger.info(f"Body args:{json.dumps(body_args)}")
+        body_args.update(get_extra_body_args())
+        # The body embeds the whole prompt, only serialize it for debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Body args: %s", orjson.dumps(body_args).decode())
 
+        # The request body is sent as bytes and the response parsed from bytes, no str round trip
         ai_response = client.invoke_model(
             modelId=model_id,
             accept="application/json",
-            body=json.dumps(body_args)
+            contentType="application/json",
+            body=orjson.dumps(body_args),
         )
 
-        ai_insights = json.loads(ai_response["body"].read().decode("utf-8"))
-        logger.info(f"AI Response: {json.dumps(ai_insights)}")
+        ai_insights = orjson.loads(ai_response["body"].read())
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("AI Response: %s", orjson.dumps(ai_insights).decode())
         return ai_insights.get("content", [{}])[0].get("text", "")
     except ClientError as e:
         if e.response["Error"]["Code"] == "ThrottlingException":
@@ -198,9 +384,16 @@ def invoke_bedrock_model(
 
 
 def schedule_retry(event: dict, context: dict) -> str:
-    client = boto3.client("events")
-    """Schedule a one-time retry event with a random delay (up to 10 minutes)."""
-    delay_seconds = random.randint(1, 600)  # Random delay between 1 and 600 seconds
+    """Schedule a one-time retry event with an exponential backoff delay (up to 10 minutes)."""
+    client = get_client("scheduler")
+    # Truncated exponential backoff with jitter, based on the number of previous retries
+    attempt = event.get("detail", {}).get("retryAttempt", 0)
+    delay_seconds = int(
+        min(
+            RETRY_MAX_DELAY_SECONDS,
+            RETRY_BASE_DELAY_SECONDS * 2**attempt + random.uniform(0, RETRY_BASE_DELAY_SECONDS),
+        )
+    )
     future_time = datetime.utcnow() + timedelta(seconds=delay_seconds)
     event_id = str(uuid.uuid4())
 
@@ -208,72 +401,90 @@ def schedule_retry(event: dict, context: dict) -> str:
     try:
         account_id = event["account"]
         region = event["region"]
-        finding_id = event["detail"]["id"]
         detector_id = event["detail"]["service"]["detectorId"]
     except KeyError as e:
-        logger.error(f"Missing expected key in event: {e}")
+        logger.error("Missing expected key in event: %s", e)
         raise ValueError("Invalid event structure")
 
-    logger.info(f"Scheduling a retry in {delay_seconds} seconds.")
+    logger.info("Scheduling a retry in %d seconds.", delay_seconds)
 
-    # Format future time into a cron expression
-    cron_expression = (
-        f"cron({future_time.minute} {future_time.hour} {future_time.day} {future_time.month} ?"
-        f" {future_time.year})"
-    )
+    # One-time schedule expression, evaluated in UTC
+    schedule_expression = f"at({future_time.strftime('%Y-%m-%dT%H:%M:%S')})"
 
     logger.info(
-        f"Attempting to schedule rule: Retry-{event_id} with ScheduleExpression: {cron_expression}"
+        "Attempting to schedule: RetryLambdaInvocation-%s with ScheduleExpression: %s",
+        event_id,
+        schedule_expression,
     )
 
-    try:
-        # Create a one-time EventBridge rule to invoke the Lambda function
-        rule_name = f"RetryLambdaInvocation-{event_id}"
-        client.put_rule(Name=rule_name, ScheduleExpression=cron_expression, State="ENABLED")
-        logger.info(f"Rule {rule_name} created successfully.")
+    # Reuse the original event, only the parts of the finding detail read by lambda_handler are
+    # kept as GuardDuty finding events can be large
+    detail = event["detail"]
+    retry_event = {
+        **event,
+        "detail": {
+            **{key: detail[key] for key in RETRY_DETAIL_KEYS if key in detail},
+            "service": {"detectorId": detector_id},
+            "retryAttempt": attempt + 1,
+        },
+    }
 
-        # Add a target for the EventBridge rule to invoke this Lambda function
+    try:
+        # Create a one-time schedule to invoke the Lambda function, it is deleted once it ran
+        schedule_name = f"RetryLambdaInvocation-{event_id}"
         lambda_arn = f"arn:aws:lambda:{region}:{account_id}:function:{context.function_name}"
-        client.put_targets(
-            Rule=rule_name,
-            Targets=[
-                {
-                    "Id": event_id,
-                    "Arn": lambda_arn,
-                    "Input": json.dumps(
-                        {
-                            "version": event["version"],
-                            "id": event["id"],
-                            "detail-type": event["detail-type"],
-                            "source": event["source"],
-                            "account": account_id,
-                            "time": event["time"],
-                            "region": region,
-                            "resources": event["resources"],
-                            "detail": {
-                                "schemaVersion": event["detail"]["schemaVersion"],
-                                "accountId": account_id,
-                                "region": region,
-                                "partition": event["detail"]["partition"],
-                                "id": finding_id,
-                                "service": {"detectorId": detector_id},
-                                "retryRuleName": f"RetryLambdaInvocation-{event_id}",
-                            },
-                        }
-                    ),
-                }
-            ],
+        client.create_schedule(
+            Name=schedule_name,
+            ScheduleExpression=schedule_expression,
+            FlexibleTimeWindow={"Mode": "OFF"},
+            ActionAfterCompletion="DELETE",
+            Target={
+                "Arn": lambda_arn,
+                "RoleArn": os.getenv("RETRY_SCHEDULER_ROLE_ARN"),
+                "Input": orjson.dumps(retry_event).decode(),
+            },
         )
-        logger.info(f"Retry scheduled with a {delay_seconds}-second delay.")
+        logger.info("Retry scheduled with a %d-second delay.", delay_seconds)
         return "rescheduled"
 
     except ClientError as e:
+        # Nothing is uploaded or notified for the finding, the failure is reported instead
         logger.error("Failed to schedule retry: %s", e)
+        raise
     except Exception as e:
         logger.error("An unexpected error occurred: %s", e)
+        raise
+
 
+def insights_line_font(line: str) -> tuple:
+    """Return the (style, size) font of a line of the AI insights."""
+    if line in INSIGHTS_H3_HEADERS:
+        return "B", 12
+    if line in INSIGHTS_H4_HEADERS:
+        return "B", 10
+    return "", 10
 
-def generate_pdf(ai_insights, guardduty_finding) -> BytesIO:
+
+def parse_insights(ai_insights: str) -> list:
+    """Split the AI insights into sections of (style, size, text) blocks.
+
+    Sections are separated by blank lines. Every header is a block of its own, consecutive
+    regular lines are joined into a single block so they can be written in one call.
+    """
+    sections = []
+    for section in INSIGHTS_SECTION_SPLIT.split(ai_insights.strip()):
+        blocks = []
+        lines = (line.strip() for line in section.split("\n"))
+        for (style, size), group in itertools.groupby(lines, key=insights_line_font):
+            if style:
+                blocks.extend((style, size, header) for header in group)
+            else:
+                blocks.append((style, size, "\n".join(group)))
+        sections.append(blocks)
+    return sections
+
+
+def generate_pdf(ai_insights, guardduty_finding) -> bytes:
     """Generate a PDF file with AI insights and GuardDuty finding details, including formatting improvements.
     """
 
@@ -311,14 +522,8 @@ def generate_pdf(ai_insights, guardduty_finding) -> BytesIO:
     region = guardduty_finding.get("Region", "us-east-1")
     finding_id = guardduty_finding.get("Id", "unknown")
 
-    guardduty_link = (
-        f"https://{region}.console.aws.amazon.com/guardduty/home?region={region}#/findings?"
-        f"search=id%3D{finding_id}&macros=current"
-    )
-    detective_link = (
-        f"https://{region}.console.aws.amazon.com/detective/home?region={region}#search?"
-        f"searchType=Finding&searchText={finding_id}"
-    )
+    guardduty_link = GUARDDUTY_FINDING_LINK.format(region=region, finding_id=finding_id)
+    detective_link = DETECTIVE_FINDING_LINK.format(region=region, finding_id=finding_id)
 
     # Add clickable GuardDuty and Detective links
     pdf.ln(10)
@@ -338,25 +543,17 @@ def generate_pdf(ai_insights, guardduty_finding) -> BytesIO:
     pdf.set_font("Arial", "B", 14)
     pdf.cell(200, 10, txt="AI Insights", ln=True)
 
-    # Parse AI insights line by line, handling double newlines
-    insights_lines = re.split(r"\n\s*\n", ai_insights.strip())  # Split by double newlines
-
-    for section in insights_lines:
-        for line in section.split("\n"):
-            # Check for specific headers
-            if line.strip() in ["Analysis:", "Remediation Actions:", "Recommended Actions:"]:
-                pdf.set_font("Arial", "B", 12)  # Set font for H3
-                pdf.cell(0, 10, txt=line.strip(), ln=True)  # Add header
-            elif line.strip() in [
-                "Entities Involved:",
-                "Security Group Impact:",
-                "Attempt Status:",
-            ]:
-                pdf.set_font("Arial", "B", 10)  # Set font for H3
-                pdf.cell(0, 10, txt=line.strip(), ln=True)  # Add header
+    # Render the parsed AI insights, only switching fonts between headers and regular text
+    font = None
+    for section in parse_insights(ai_insights):
+        for style, size, text in section:
+            if font != (style, size):
+                font = (style, size)
+                pdf.set_font("Arial", style, size)
+            if style:
+                pdf.cell(0, 10, txt=text, ln=True)  # Add header
             else:
-                pdf.set_font("Arial", "", 10)  # Set back to normal font
-                pdf.multi_cell(0, 10, txt=line.strip())  # Add regular text
+                pdf.multi_cell(0, 10, txt=text)  # Add regular text
 
         pdf.ln(5)  # Add some space between sections
 
@@ -364,157 +561,249 @@ def generate_pdf(ai_insights, guardduty_finding) -> BytesIO:
     pdf.ln(10)
     pdf.set_font("Arial", "B", 14)
     pdf.cell(200, 10, txt="Conclusion and Recommended Actions", ln=True)
-
-    summary_text = (
-        "The above insights and recommendations provide detailed information on mitigating the"
-        " identified threat. Please ensure the recommended security actions are promptly applied to"
-        " minimize future risks."
-    )
     pdf.set_font("Arial", "", 12)
-    pdf.multi_cell(0, 10, txt=summary_text)
+    pdf.multi_cell(0, 10, txt=REPORT_SUMMARY_TEXT)
 
     # Generate PDF in memory
-    pdf_buffer = BytesIO()
-    pdf_output = pdf.output(dest="S").encode("latin1")  # Return as string and encode
-    pdf_buffer.write(pdf_output)
-    pdf_buffer.seek(0)
-
-    return pdf_buffer
+    return pdf.output(dest="S").encode("latin1")
 
 
-def upload_pdf_to_s3(client: boto3.client, pdf_buffer: BytesIO, file_name: str, bucket_name: str):
-    """Upload the PDF to S3 and return the pre-signed URL."""
+def upload_insights_to_s3(
+    client: boto3.client, finding: dict, ai_insights: str, file_name: str, bucket_name: str
+):
+    """Upload the GuardDuty finding and AI insights to S3 for the PDF generation."""
     try:
-        # Upload the PDF file to S3
         client.put_object(
-            Bucket=bucket_name, Key=file_name, Body=pdf_buffer, ContentType="application/pdf"
+            Bucket=bucket_name,
+            Key=file_name,
+            Body=orjson.dumps(
+                {"finding": finding, "ai_insights": ai_insights},
+                default=json_default,
+                option=JSON_OPTIONS,
+            ),
+            ContentType="application/json",
         )
+    except Exception as e:
+        logger.error("Error uploading AI insights to S3: %s", e)
+        raise
+
+
+def get_report_url(client: boto3.client, file_name: str, bucket_name: str) -> str:
+    """Generate the pre-signed URL of a report, the report doesn't need to exist yet."""
+    return client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket_name, "Key": file_name},
+        ExpiresIn=3600,  # URL expires in 1 hour
+    )
 
-        # Generate a pre-signed URL for the PDF
-        pre_signed_url = client.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": bucket_name, "Key": file_name},
-            ExpiresIn=3600,  # URL expires in 1 hour
-        )
 
-        return pre_signed_url
+def upload_pdf_to_s3(client: boto3.client, pdf_bytes: bytes, file_name: str, bucket_name: str):
+    """Upload the PDF to S3."""
+    try:
+        # The body is sent as is, its length is known up front
+        client.put_object(
+            Bucket=bucket_name,
+            Key=file_name,
+            Body=pdf_bytes,
+            ContentLength=len(pdf_bytes),
+            ContentType="application/pdf",
+        )
     except Exception as e:
-        logger.error(f"Error uploading PDF to S3: {e}")
+        logger.error("Error uploading PDF to S3: %s", e)
         raise
 
 
 def send_sns_notification(client: boto3.client, pre_signed_url: str, topic_arn: str):
     """Send SNS notification with the pre-signed URL."""
     try:
-        # Ensure URL is stripped and encoded
-        pre_signed_url = pre_signed_url.strip().replace(" ", "%20")
-        logger.info(
-            f"Encoded Pre-signed URL: {pre_signed_url}"
-        )  # Log the encoded URL for debugging
-
-        # Compose message in a simplified HTML format
-        message = (
-            "New GuardDuty finding. Enriched PDF with AI remediation's can be downloaded here: "
-            f"{pre_signed_url}"
-        )
+        # Pre-signed URLs generated by boto3 are already percent-encoded
+        logger.info("Pre-signed URL: %s", pre_signed_url)
 
-        # Create the SNS message structure with JSON to support HTML
-        message_structure = {
-            "default": "New GuardDuty finding with enriched PDF. Click the link to download.",
-            "email": message,
-        }
-
-        # Publish to SNS
+        # Publish to SNS, the URL doesn't contain characters that need escaping in JSON
         client.publish(
             TopicArn=topic_arn,
-            Message=json.dumps(message_structure),
-            Subject="GuardDuty Finding Enrichment Report",
+            Message=SNS_MESSAGE_TEMPLATE.replace("{url}", pre_signed_url),
+            Subject=SNS_SUBJECT,
             MessageStructure="json",
         )
 
         logger.info("Notification sent to SNS")
     except Exception as e:
-        logger.error(f"Error sending SNS notification: {e}")
+        logger.error("Error sending SNS notification: %s", e)
         raise
 
 
-def remove_retry_event_rule(client: boto3.client, event_rule_name: str):
+def send_sns_notifications(client: boto3.client, pre_signed_urls: dict, topic_arn: str) -> list:
+    """Send the SNS notifications of a batch, returns the ids of the undelivered notifications."""
+    failed_ids = []
+    items = list(pre_signed_urls.items())
+    for start in range(0, len(items), SNS_PUBLISH_BATCH_SIZE):
+        entries = [
+            {
+                "Id": notification_id,
+                "Message": SNS_MESSAGE_TEMPLATE.replace("{url}", pre_signed_url),
+                "Subject": SNS_SUBJECT,
+                "MessageStructure": "json",
+            }
+            for notification_id, pre_signed_url in items[start : start + SNS_PUBLISH_BATCH_SIZE]
+        ]
+        try:
+            response = client.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+        except Exception as e:
+            logger.error("Error sending SNS notifications: %s", e)
+            failed_ids.extend(entry["Id"] for entry in entries)
+            continue
+        for failed in response.get("Failed", []):
+            logger.error("Error sending SNS notification %s: %s", failed["Id"], failed["Code"])
+            failed_ids.append(failed["Id"])
+    logger.info("%d notifications sent to SNS", len(items) - len(failed_ids))
+    return failed_ids
+
+
+def has_confirmed_subscriptions(client: boto3.client, topic_arn: str) -> bool:
+    """Check if anybody receives the notifications of a topic, cached on warm invocations."""
+    confirmed = _get_cached(_topic_subscriptions, topic_arn)
+    if confirmed is not None:
+        return confirmed
     try:
-        logger.info(f"Deleting EventBridge rule: {event_rule_name}")
-        client.delete_rule(Name=event_rule_name)
-        logger.info(f"Deleted EventBridge rule: {event_rule_name}")
+        attributes = client.get_topic_attributes(TopicArn=topic_arn)["Attributes"]
+        confirmed = attributes["SubscriptionsConfirmed"] != "0"
+        if not confirmed:
+            logger.info("Topic %s has no confirmed subscriptions, skipping the reports", topic_arn)
+        _set_cached(_topic_subscriptions, topic_arn, confirmed, SUBSCRIPTIONS_CACHE_TTL_SECONDS)
+        return confirmed
     except Exception as e:
-        logger.error(f"Error deleting EventBridge rule: {e}")
+        logger.error("Error retrieving SNS topic attributes: %s", e)
+        raise
+
+
+def process_finding(event: dict, context, bucket_name: str, notify: bool = True) -> tuple:
+    """
+    Analyze the GuardDuty finding of an event and store the AI insights for the PDF report.
+
+    The insights are only stored, and the PDF report generated from them, if the report is
+    notified.
+
+    Returns:
+        tuple: The AI insights or the reason the finding was not analyzed, and the pre-signed
+        URL of the report, which is None if there is nothing to notify.
+    """
+    detective_client = get_client("detective")
+    guardduty_client = get_client("guardduty")
+    bedrock_client = get_client("bedrock-runtime")
+    s3_client = get_client("s3")
+    finding_id = event["detail"]["id"]
+    detector_id = event["detail"]["service"]["detectorId"]
+    logger.info(
+        "Processing GuardDuty finding: %s for detector with ID: %s", finding_id, detector_id
+    )
+    # The Detective lookups don't depend on the finding, fetch them while it is retrieved
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        finding_future = executor.submit(
+            get_guardduty_finding, guardduty_client, detector_id, finding_id
+        )
+        detective_entities_future = executor.submit(get_detective_entities, detective_client)
+        # Findings below severity 4.0 are already filtered out by the EventBridge rule
+        finding = finding_future.result()
+        detective_entities = detective_entities_future.result()
+
+    # AI Analysis with Amazon Bedrock
+    ai_insights = invoke_bedrock_model(bedrock_client, finding, detective_entities, event, context)
+    if ai_insights == "rescheduled":
+        return "Event scheduled.", None
+    if not notify:
+        return ai_insights, None
+    # Store the AI insights, the PDF is generated from them by pdf_handler
+    upload_insights_to_s3(
+        s3_client, finding, ai_insights, f"{INSIGHTS_PREFIX}{finding_id}.json", bucket_name
+    )
+
+    # The pre-signed URL points to the PDF that pdf_handler is about to write
+    return ai_insights, get_report_url(s3_client, f"{finding_id}.pdf", bucket_name)
+
+
+def process_batch(records: list, context, bucket_name: str, topic_arn: str) -> dict:
+    """Process the GuardDuty events of an SQS batch, failed messages are reported for retry."""
+    failed_ids = []
+    pre_signed_urls = {}
+    # Nobody receives the report links without a confirmed subscription. The decision is made
+    # once, and only the notified reports get a PDF, so every link points to a generated report
+    notify = has_confirmed_subscriptions(get_client("sns"), topic_arn)
+    with ThreadPoolExecutor(max_workers=min(len(records), MAX_BATCH_WORKERS) or 1) as executor:
+        futures = {}
+        for record in records:
+            message_id = record["messageId"]
+            # A malformed message only fails itself, the other findings are still processed
+            try:
+                event = orjson.loads(record["body"])
+            except Exception as e:
+                logger.error("Error in parsing message %s: %s", message_id, e)
+                failed_ids.append(message_id)
+                continue
+            future = executor.submit(process_finding, event, context, bucket_name, notify)
+            futures[future] = message_id
+        for future, message_id in futures.items():
+            try:
+                _, pre_signed_url = future.result()
+            except Exception as e:
+                logger.error("Error in processing message %s: %s", message_id, e)
+                failed_ids.append(message_id)
+                continue
+            if pre_signed_url:
+                pre_signed_urls[message_id] = pre_signed_url
+
+    # Notify about all reports of the batch at once
+    if pre_signed_urls:
+        failed_ids.extend(send_sns_notifications(get_client("sns"), pre_signed_urls, topic_arn))
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_ids]}
 
 
 def lambda_handler(event, context):
-    logger.info("Received event: %s", json.dumps(event, indent=4))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Received event: %s", orjson.dumps(event).decode()[:MAX_LOGGED_EVENT_LENGTH])
     sns_topic_arn = os.getenv("AI_REPORTS_TOPIC_ARN")
     s3_bucket_name = os.getenv("AI_REPORTS_BUCKET_NAME")
-    detective_client = boto3.client("detective")
-    guardduty_client = boto3.client("guardduty")
-    bedrock_client = boto3.client("bedrock-runtime")
-    s3_client = boto3.client("s3")
-    sns_client = boto3.client("sns")
     if not s3_bucket_name:
         logger.error("Environment variable AI_REPORTS_BUCKET_NAME is not set")
         raise ValueError("Environment variable AI_REPORTS_BUCKET_NAME is not set")
     if not sns_topic_arn:
         logger.error("Environment variable AI_REPORTS_TOPIC_ARN is not set")
         raise ValueError("Environment variable AI_REPORTS_TOPIC_ARN is not set")
+    # The findings are delivered in batches through SQS, retries invoke the function directly
+    if "Records" in event:
+        return process_batch(event["Records"], context, s3_bucket_name, sns_topic_arn)
     try:
-        finding_id = event["detail"]["id"]
-        detector_id = event["detail"]["service"]["detectorId"]
-        logger.info(
-            f"Processing GuardDuty finding: {finding_id} for detector with ID: {detector_id}"
-        )
-        # Get GuardDuty finding details
-        finding = get_guardduty_finding(guardduty_client, detector_id, finding_id)
-        # only proceed if severity if bigger then 4.0
-        if finding["Severity"] < 4.0:
-            logger.info(
-                f"Finding {finding_id} has severity of {finding['Severity']} not processing"
-            )
-            return {
-                "statusCode": 200,
-                "body": json.dumps(
-                    f"Finding {finding_id} has severity of {finding['Severity']} not processing"
-                ),
-            }
-
-        # Get the graph ARN for Amazon Detective
-        graph_arn = get_graph_arn(detective_client)
-
-        # Get all entity details from Amazon Detective
-        detective_entities = get_all_detective_entities(detective_client, graph_arn)
-
-        # Convert enriched_data to use Decimal for float types
-        finding = convert_to_json_serializable(finding)
-        detective_entities = convert_to_json_serializable(detective_entities)
-
-        # AI Analysis with Amazon Bedrock
-        ai_insights = invoke_bedrock_model(
-            bedrock_client, finding, detective_entities, event, context
-        )
-        if ai_insights == "rescheduled":
-            return {"statusCode": 200, "body": json.dumps("Event scheduled.")}
-        # Generate PDF with AI insights and GuardDuty information
-        pdf_buffer = generate_pdf(ai_insights, finding)
-
-        # Upload PDF to S3 and get pre-signed URL
-        file_name = f"{finding_id}.pdf"
-
-        pre_signed_url = upload_pdf_to_s3(s3_client, pdf_buffer, file_name, s3_bucket_name)
-
-        # Send SNS notification with pre-signed URL
-        send_sns_notification(sns_client, pre_signed_url, sns_topic_arn)
-
-        # if case this is a rescheduled event, lets clean it to keep the event bridge clean
-        # Check if 'retryRuleName' exists and remove the retry event rule if it does
-        retry_rule_name = event["detail"].get("retryRuleName")  # Use get() to avoid KeyError
-        if retry_rule_name:
-            remove_retry_event_rule(sns_client, retry_rule_name)
+        # The PDF is only generated if the report is notified, as for the batches
+        notify = has_confirmed_subscriptions(get_client("sns"), sns_topic_arn)
+        result, pre_signed_url = process_finding(event, context, s3_bucket_name, notify)
+        if pre_signed_url:
+            # Send SNS notification with pre-signed URL
+            send_sns_notification(get_client("sns"), pre_signed_url, sns_topic_arn)
     except Exception as e:
         logger.error("Error in processing: %s", e)
-        return {"statusCode": 500, "body": json.dumps(f"Error in processing: {e}")}
-    return {"statusCode": 200, "body": json.dumps(ai_insights)}
+        return {"statusCode": 500, "body": orjson.dumps(f"Error in processing: {e}").decode()}
+    return {"statusCode": 200, "body": orjson.dumps(result).decode()}
+
+
+def pdf_handler(event, context):
+    """Generate the PDF reports for the AI insights uploaded to S3."""
+    s3_client = get_client("s3")
+    file_names = []
+    for record in event["Records"]:
+        bucket_name = record["s3"]["bucket"]["name"]
+        key = unquote_plus(record["s3"]["object"]["key"])
+        logger.info("Generating PDF report for s3://%s/%s", bucket_name, key)
+        try:
+            insights = orjson.loads(
+                s3_client.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+            )
+            pdf_bytes = generate_pdf(insights["ai_insights"], insights["finding"])
+
+            file_name = f"{os.path.splitext(os.path.basename(key))[0]}.pdf"
+            upload_pdf_to_s3(s3_client, pdf_bytes, file_name, bucket_name)
+            file_names.append(file_name)
+        except Exception as e:
+            # Let the asynchronous invocation retry the event
+            logger.error("Error generating PDF report for %s: %s", key, e)
+            raise
+    return {"statusCode": 200, "body": orjson.dumps(file_names).decode()}
@@ -5,6 +5,8 @@ from unittest import mock
 import pytest
 from attr import dataclass
 
+from app.ai_generator import index
+
 ACCOUNT_ID = "123456789012"
 REGION = "us-east-1"
 FINDING_ID = "test_finding_id"
@@ -24,6 +26,7 @@ TEST_FINDING = {
     ]
 }
 SNS_TOPIC_ARN = "arn:aws:sns:us-east-1:123456789012:my-test-topic"
+RETRY_SCHEDULER_ROLE_ARN = "arn:aws:iam::123456789012:role/RetrySchedulerRole"
 EVENT = {
     "version": "0",
     "id": "sample-event-id",
@@ -114,9 +117,19 @@ def mock_bedrock_client(get_bedrock_invoke_model_response):
 
 
 @pytest.fixture()
-def mock_events_client():
-    events_client = mock.MagicMock(name="MockEventsClient")
-    return events_client
+def mock_scheduler_client():
+    scheduler_client = mock.MagicMock(name="MockSchedulerClient")
+    return scheduler_client
+
+
+# Drop the boto3 clients and lookups cached by the lambda module so each test gets its own mocks
+@pytest.fixture(autouse=True)
+def reset_clients():
+    index._reset_clients()
+    index._reset_caches()
+    yield
+    index._reset_clients()
+    index._reset_caches()
 
 
 # Generates a mock lambda context
@@ -148,6 +161,7 @@ def aws_credentials():
     os.environ["LOG_LEVEL"] = "DEBUG"
     os.environ["AI_REPORTS_TOPIC_ARN"] = SNS_TOPIC_ARN
     os.environ["AI_REPORTS_BUCKET_NAME"] = S3_BUCKET_NAME
+    os.environ["RETRY_SCHEDULER_ROLE_ARN"] = RETRY_SCHEDULER_ROLE_ARN
     os.environ["BEDROCK_MODEL_ID"] = "anthropic.claude-3-5-sonnet-20240620-v1:0"
     os.environ["body_args_anthropic_version"] = "dummy"
 
@@ -1,53 +1,183 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from io import BytesIO
 from unittest import mock
 
 import assertpy
+import orjson
 import pytest
 from botocore.exceptions import ClientError
 
 from app.ai_generator import index
 from app.ai_generator.index import (
+    DETECTIVE_ENTITY_FIELDS,
     generate_pdf,
     get_all_detective_entities,
     get_graph_arn,
     get_guardduty_finding,
     invoke_bedrock_model,
+    parse_insights,
+    schedule_retry,
     send_sns_notification,
+    slim_detective_entities,
+    to_json,
 )
 from app.tests.conftest import (
     DETECTOR_ID,
     FINDING_ID,
     GRAPH_ARN,
     MEMBER_DETAILS,
+    RETRY_SCHEDULER_ROLE_ARN,
+    S3_BUCKET_NAME,
     SNS_TOPIC_ARN,
     TEST_FINDING,
 )
 
 
+@mock.patch("boto3.client")
+def test_get_client_is_cached(mock_boto_client):
+    client = index.get_client("sns")
+    assertpy.assert_that(index.get_client("sns")).is_same_as(client)
+    mock_boto_client.assert_called_once_with("sns", config=index.CONNECTION_CONFIG)
+
+
+def test_client_configs_keep_connections_alive():
+    bedrock_config = index.CLIENT_CONFIGS["bedrock-runtime"]
+    assertpy.assert_that(bedrock_config.tcp_keepalive).is_true()
+    assertpy.assert_that(bedrock_config.retries).is_equal_to(
+        {"max_attempts": 2, "mode": "adaptive"}
+    )
+    assertpy.assert_that(index.CLIENT_CONFIGS["s3"].tcp_keepalive).is_true()
+    assertpy.assert_that(index.CLIENT_CONFIGS["s3"].max_pool_connections).is_equal_to(20)
+
+
+def test_client_configs_fit_function_timeout():
+    def worst_case(service_name, calls=1):
+        config = index.CLIENT_CONFIGS[service_name]
+        return (
+            calls * config.retries["max_attempts"] * (config.connect_timeout + config.read_timeout)
+        )
+
+    # The sequential calls of a finding, the GuardDuty finding is retrieved in parallel to the
+    # two Detective calls. The backoff between attempts is covered by the remaining margin
+    budget = (
+        max(worst_case("guardduty"), worst_case("detective", calls=2))
+        + worst_case("bedrock-runtime")
+        + worst_case("s3")
+        + worst_case("sns")
+    )
+    assertpy.assert_that(budget).is_less_than_or_equal_to(index.FUNCTION_TIMEOUT_SECONDS - 30)
+
+
+def test_to_json_serializes_decimal_and_datetime():
+    data = {"Severity": Decimal("6.5"), "UpdatedAt": datetime(2024, 10, 18, 11, 40, 1)}
+    assertpy.assert_that(to_json(data)).is_equal_to(
+        '{"Severity":6.5,"UpdatedAt":"2024-10-18T11:40:01Z"}'
+    )
+
+
 def test_get_guardduty_finding(mock_guardduty_client):
     finding = get_guardduty_finding(mock_guardduty_client, DETECTOR_ID, FINDING_ID)
     assertpy.assert_that(finding).is_not_none()
     assertpy.assert_that(finding["Id"]).is_equal_to(FINDING_ID)
 
 
+def test_get_guardduty_finding_is_cached(mock_guardduty_client):
+    get_guardduty_finding(mock_guardduty_client, DETECTOR_ID, FINDING_ID)
+    finding = get_guardduty_finding(mock_guardduty_client, DETECTOR_ID, FINDING_ID)
+    assertpy.assert_that(finding["Id"]).is_equal_to(FINDING_ID)
+    mock_guardduty_client.get_findings.assert_called_once()
+
+
+@mock.patch("app.ai_generator.index.LOOKUP_CACHE_MAX_SIZE", 4)
+def test_set_cached_evicts_concurrently():
+    cache = {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda key: index._set_cached(cache, key, key, 60), range(1000)))
+    assertpy.assert_that(len(cache)).is_less_than_or_equal_to(4)
+
+
 def test_get_graph_arn(mock_detective_client):
     graph_arn = get_graph_arn(mock_detective_client)
     assertpy.assert_that(graph_arn).is_not_none()
     assertpy.assert_that(graph_arn).is_equal_to(GRAPH_ARN)
 
 
+def test_get_graph_arn_is_cached(mock_detective_client):
+    get_graph_arn(mock_detective_client)
+    graph_arn = get_graph_arn(mock_detective_client)
+    assertpy.assert_that(graph_arn).is_equal_to(GRAPH_ARN)
+    mock_detective_client.list_graphs.assert_called_once()
+
+
 def test_get_all_detective_entities(mock_detective_client):
     entities = get_all_detective_entities(mock_detective_client, GRAPH_ARN)
     assertpy.assert_that(entities).is_not_empty()
     assertpy.assert_that(entities).is_equal_to(MEMBER_DETAILS)
 
 
+@mock.patch("app.ai_generator.index.MAX_DETECTIVE_ENTITIES", 3)
+def test_get_all_detective_entities_paginates(mock_detective_client):
+    mock_detective_client.list_members.side_effect = [
+        {"MemberDetails": [{"AccountId": "1"}, {"AccountId": "2"}], "NextToken": "token"},
+        {"MemberDetails": [{"AccountId": "3"}, {"AccountId": "4"}], "NextToken": "token2"},
+    ]
+    entities = get_all_detective_entities(mock_detective_client, GRAPH_ARN)
+    assertpy.assert_that(entities).extracting("AccountId").is_equal_to(["1", "2", "3"])
+    assertpy.assert_that(mock_detective_client.list_members.call_count).is_equal_to(2)
+    mock_detective_client.list_members.assert_called_with(GraphArn=GRAPH_ARN, NextToken="token")
+
+
+def test_slim_detective_entities():
+    entities = [
+        {
+            "AccountId": "123456789012",
+            "EmailAddress": "test@example.com",
+            "GraphArn": GRAPH_ARN,
+            "Status": "ENABLED",
+            "VolumeUsageInBytes": 1024,
+        },
+        {"AccountId": "210987654321"},
+    ]
+    assertpy.assert_that(slim_detective_entities(entities)).is_equal_to(
+        [
+            {"AccountId": "123456789012", "EmailAddress": "test@example.com", "Status": "ENABLED"},
+            {"AccountId": "210987654321"},
+        ]
+    )
+
+
 def test_invoke_bedrock_model(mock_bedrock_client, lambda_context, get_guardduty_event):
+    detective_entities = [
+        {
+            "AccountId": "123456789012",
+            "EmailAddress": "test@example.com",
+            "Status": "ACCEPTED_BUT_DISABLED",
+            "DisabledReason": "VOLUME_TOO_HIGH",
+            "InvitedTime": datetime(2024, 1, 1),
+            "UpdatedTime": datetime(2024, 1, 2),
+            "GraphArn": GRAPH_ARN,
+            "VolumeUsageInBytes": 1024,
+        }
+    ]
     ai_insights = invoke_bedrock_model(
-        mock_bedrock_client, TEST_FINDING, DETECTOR_ID, get_guardduty_event, lambda_context
+        mock_bedrock_client, TEST_FINDING, detective_entities, get_guardduty_event, lambda_context
     )
     assertpy.assert_that(ai_insights).is_not_none()
     assertpy.assert_that(ai_insights).is_equal_to("Test AI Insights")
+    invoke_kwargs = mock_bedrock_client.invoke_model.call_args.kwargs
+    assertpy.assert_that(invoke_kwargs["contentType"]).is_equal_to("application/json")
+    assertpy.assert_that(orjson.loads(invoke_kwargs["body"])["max_tokens"]).is_equal_to(5000)
+    assertpy.assert_that(orjson.loads(invoke_kwargs["body"])["anthropic_version"]).is_equal_to(
+        "dummy"
+    )
+    # Only the relevant fields of the Detective entities are serialized into the prompt
+    prompt = orjson.loads(invoke_kwargs["body"])["messages"][0]["content"]
+    slim_entities = [{key: detective_entities[0][key] for key in DETECTIVE_ENTITY_FIELDS}]
+    assertpy.assert_that(prompt).contains(f"Detective entities involved: {to_json(slim_entities)}.")
+    assertpy.assert_that(prompt).does_not_contain(GRAPH_ARN, "VolumeUsageInBytes")
 
 
 def test_generate_pdf():
@@ -57,30 +187,65 @@ def test_generate_pdf():
         "Severity": 6,
         "Type": "UnauthorizedAccess:EC2/SSHBruteForce",
     }
-    pdf_buffer = generate_pdf(ai_insights, guardduty_finding)
-    assertpy.assert_that(pdf_buffer).is_not_none()
-    assertpy.assert_that(len(pdf_buffer.getvalue())).is_greater_than(0)
+    pdf_bytes = generate_pdf(ai_insights, guardduty_finding)
+    assertpy.assert_that(pdf_bytes).is_instance_of(bytes)
+    assertpy.assert_that(pdf_bytes[:5]).is_equal_to(b"%PDF-")
+
+
+def test_parse_insights():
+    ai_insights = (
+        "Analysis:\nFirst line\n  Second line\n\nRemediation Actions:\nAttempt Status:\n1. Act"
+    )
+    assertpy.assert_that(parse_insights(ai_insights)).is_equal_to(
+        [
+            [("B", 12, "Analysis:"), ("", 10, "First line\nSecond line")],
+            [("B", 12, "Remediation Actions:"), ("B", 10, "Attempt Status:"), ("", 10, "1. Act")],
+        ]
+    )
 
 
 def test_sns_notification(mock_sns_client):
     pre_signed_url = "https://example.com/pre-signed-url"
-    pre_signed_url2 = pre_signed_url.strip().replace(" ", "%20")
     message = {
         "default": "New GuardDuty finding with enriched PDF. Click the link to download.",
         "email": (
             "New GuardDuty finding. Enriched PDF with AI remediation's can be downloaded here: "
-            f"{pre_signed_url2}"
+            f"{pre_signed_url}"
         ),
     }
     send_sns_notification(mock_sns_client, pre_signed_url, SNS_TOPIC_ARN)
     mock_sns_client.publish.assert_called_once_with(
         TopicArn=SNS_TOPIC_ARN,
-        Message=json.dumps(message),
+        Message=orjson.dumps(message).decode(),
         Subject="GuardDuty Finding Enrichment Report",
         MessageStructure="json",
     )
 
 
+@mock.patch("app.ai_generator.index.get_client")
+def test_schedule_retry_increments_attempt(
+    mock_get_client, mock_scheduler_client, lambda_context, get_guardduty_event
+):
+    mock_get_client.return_value = mock_scheduler_client
+    event = {**get_guardduty_event, "detail": {**get_guardduty_event["detail"], "retryAttempt": 2}}
+    response = schedule_retry(event, lambda_context)
+    assertpy.assert_that(response).is_equal_to("rescheduled")
+    mock_get_client.assert_called_once_with("scheduler")
+    schedule_kwargs = mock_scheduler_client.create_schedule.call_args.kwargs
+    assertpy.assert_that(schedule_kwargs["ScheduleExpression"]).matches(
+        r"^at\(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\)$"
+    )
+    assertpy.assert_that(schedule_kwargs["ActionAfterCompletion"]).is_equal_to("DELETE")
+    assertpy.assert_that(schedule_kwargs["Target"]["RoleArn"]).is_equal_to(RETRY_SCHEDULER_ROLE_ARN)
+    retry_input = orjson.loads(schedule_kwargs["Target"]["Input"])
+    assertpy.assert_that(retry_input["detail"]["retryAttempt"]).is_equal_to(3)
+    assertpy.assert_that(retry_input["detail-type"]).is_equal_to(event["detail-type"])
+    assertpy.assert_that(retry_input["detail"]).does_not_contain_key("resource")
+    assertpy.assert_that(retry_input["detail"]["service"]).is_equal_to(
+        {"detectorId": "sample-detector"}
+    )
+
+
 # Configure boto3 client mock to return the correct client based on input
 @pytest.fixture
 def boto_client_side_effect():
@@ -91,7 +256,11 @@ def boto_client_side_effect():
     mock_detective_client = mock.Mock(name="MockDetectiveClient")
     mock_bedrock_client = mock.Mock(name="MockBedrockClient")
     mock_s3_client = mock.Mock(name="MockS3Client")
-    mock_events_client = mock.Mock(name="MockEventsClient")
+    mock_scheduler_client = mock.Mock(name="MockSchedulerClient")
+    # The reports topic has a confirmed subscription unless a test says otherwise
+    mock_sns_client.get_topic_attributes.return_value = {
+        "Attributes": {"SubscriptionsConfirmed": "1"}
+    }
 
     # Define the side effect function
     def client_side_effect(service_name, *args, **kwargs):
@@ -105,8 +274,8 @@ def boto_client_side_effect():
             return mock_bedrock_client
         elif service_name == "s3":
             return mock_s3_client
-        elif service_name == "events":
-            return mock_events_client
+        elif service_name == "scheduler":
+            return mock_scheduler_client
         else:
             raise ValueError(f"Unexpected service: {service_name}")
 
@@ -117,7 +286,7 @@ def boto_client_side_effect():
         "detective": mock_detective_client,
         "bedrock": mock_bedrock_client,
         "s3": mock_s3_client,
-        "events": mock_events_client,
+        "scheduler": mock_scheduler_client,
     }
 
 
@@ -153,6 +322,116 @@ def test_lambda_handler(
     mock_clients["s3"].put_object.assert_called_once()
     mock_clients["s3"].generate_presigned_url.assert_called_once()
     mock_clients["sns"].publish.assert_called_once()
+    put_object_kwargs = mock_clients["s3"].put_object.call_args.kwargs
+    assertpy.assert_that(put_object_kwargs["Key"]).is_equal_to(f"insights/{FINDING_ID}.json")
+    assertpy.assert_that(orjson.loads(put_object_kwargs["Body"])["ai_insights"]).is_equal_to(
+        "Test AI Insights"
+    )
+
+
+@mock.patch("boto3.client")
+def test_lambda_handler_sqs_batch(
+    mock_boto_client,
+    boto_client_side_effect,
+    lambda_context,
+    get_bedrock_invoke_model_response,
+    get_detective_list_graphs_response,
+    get_detective_list_members_response,
+    get_guardduty_event,
+):
+    client_side_effect, mock_clients = boto_client_side_effect
+    mock_boto_client.side_effect = client_side_effect
+
+    mock_clients["guardduty"].get_findings.return_value = TEST_FINDING
+    mock_clients["detective"].list_members.return_value = get_detective_list_members_response
+    mock_clients["detective"].list_graphs.return_value = get_detective_list_graphs_response
+    mock_clients["bedrock"].invoke_model.return_value = get_bedrock_invoke_model_response
+    mock_clients["s3"].generate_presigned_url.return_value = "https://dummyurl"
+    mock_clients["sns"].publish_batch.return_value = {"Successful": [], "Failed": []}
+    event = {
+        "Records": [
+            {"messageId": "message-1", "body": orjson.dumps(get_guardduty_event).decode()},
+            {"messageId": "message-2", "body": orjson.dumps({"detail": {}}).decode()},
+            {"messageId": "message-3", "body": "not json"},
+        ]
+    }
+    response = index.lambda_handler(event, lambda_context)
+    assertpy.assert_that(response["batchItemFailures"]).contains_only(
+        {"itemIdentifier": "message-2"}, {"itemIdentifier": "message-3"}
+    )
+    mock_clients["bedrock"].invoke_model.assert_called_once()
+    publish_batch_kwargs = mock_clients["sns"].publish_batch.call_args.kwargs
+    assertpy.assert_that(publish_batch_kwargs["TopicArn"]).is_equal_to(SNS_TOPIC_ARN)
+    assertpy.assert_that(publish_batch_kwargs["PublishBatchRequestEntries"]).extracting(
+        "Id"
+    ).is_equal_to(["message-1"])
+    mock_clients["sns"].publish.assert_not_called()
+
+
+@mock.patch("boto3.client")
+def test_pdf_handler(mock_boto_client, mock_s3_client, lambda_context):
+    mock_boto_client.return_value = mock_s3_client
+    insights = {"finding": TEST_FINDING["Findings"][0], "ai_insights": "Test AI Insights"}
+    mock_s3_client.get_object.return_value = {"Body": BytesIO(orjson.dumps(insights))}
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": S3_BUCKET_NAME},
+                    "object": {"key": f"insights/{FINDING_ID}.json"},
+                }
+            }
+        ]
+    }
+    response = index.pdf_handler(event, lambda_context)
+    assertpy.assert_that(orjson.loads(response["body"])).is_equal_to([f"{FINDING_ID}.pdf"])
+    mock_s3_client.get_object.assert_called_once_with(
+        Bucket=S3_BUCKET_NAME, Key=f"insights/{FINDING_ID}.json"
+    )
+    put_object_kwargs = mock_s3_client.put_object.call_args.kwargs
+    assertpy.assert_that(put_object_kwargs["Key"]).is_equal_to(f"{FINDING_ID}.pdf")
+    assertpy.assert_that(put_object_kwargs["ContentType"]).is_equal_to("application/pdf")
+    assertpy.assert_that(put_object_kwargs["ContentLength"]).is_equal_to(
+        len(put_object_kwargs["Body"])
+    )
+
+
+@mock.patch("boto3.client")
+def test_lambda_handler_sqs_batch_without_subscriptions(
+    mock_boto_client,
+    boto_client_side_effect,
+    lambda_context,
+    get_detective_list_graphs_response,
+    get_detective_list_members_response,
+    get_guardduty_event,
+):
+    client_side_effect, mock_clients = boto_client_side_effect
+    mock_boto_client.side_effect = client_side_effect
+
+    mock_clients["guardduty"].get_findings.return_value = TEST_FINDING
+    mock_clients["detective"].list_members.return_value = get_detective_list_members_response
+    mock_clients["detective"].list_graphs.return_value = get_detective_list_graphs_response
+    mock_clients["bedrock"].invoke_model.side_effect = lambda **kwargs: {
+        "body": BytesIO(b'{"content": [{"text": "Test AI Insights"}]}')
+    }
+    mock_clients["sns"].get_topic_attributes.return_value = {
+        "Attributes": {"SubscriptionsConfirmed": "0"}
+    }
+    body = orjson.dumps(get_guardduty_event).decode()
+    event = {
+        "Records": [
+            {"messageId": "message-1", "body": body},
+            {"messageId": "message-2", "body": body},
+        ]
+    }
+    response = index.lambda_handler(event, lambda_context)
+    assertpy.assert_that(response).is_equal_to({"batchItemFailures": []})
+    # The subscriptions are checked once per batch, without subscribers no report is generated
+    # and no link is sent
+    mock_clients["sns"].get_topic_attributes.assert_called_once_with(TopicArn=SNS_TOPIC_ARN)
+    mock_clients["s3"].put_object.assert_not_called()
+    mock_clients["s3"].generate_presigned_url.assert_not_called()
+    mock_clients["sns"].publish_batch.assert_not_called()
 
 
 @mock.patch("boto3.client")
@@ -174,12 +453,48 @@ def test_lambda_handler_bedrock_throttling(
     mock_clients["bedrock"].invoke_model.side_effect = ClientError(
         {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeModel"
     )
-    mock_clients["events"].put_events.return_value = None
+    mock_clients["scheduler"].create_schedule.return_value = None
     response = index.lambda_handler(get_guardduty_event, lambda_context)
     mock_clients["guardduty"].get_findings.assert_called_once()
     mock_clients["detective"].list_members.assert_called_once()
     mock_clients["detective"].list_graphs.assert_called_once()
     mock_clients["bedrock"].invoke_model.assert_called_once()
+    mock_clients["scheduler"].create_schedule.assert_called_once()
     assertpy.assert_that(response).is_not_none()
     assertpy.assert_that(response["statusCode"]).is_equal_to(200)
     assertpy.assert_that(json.loads(response["body"])).is_equal_to("Event scheduled.")
+
+
+@mock.patch("boto3.client")
+def test_lambda_handler_sqs_batch_retry_scheduling_fails(
+    mock_boto_client,
+    boto_client_side_effect,
+    lambda_context,
+    get_detective_list_graphs_response,
+    get_detective_list_members_response,
+    get_guardduty_event,
+):
+    client_side_effect, mock_clients = boto_client_side_effect
+    mock_boto_client.side_effect = client_side_effect
+
+    mock_clients["guardduty"].get_findings.return_value = TEST_FINDING
+    mock_clients["detective"].list_members.return_value = get_detective_list_members_response
+    mock_clients["detective"].list_graphs.return_value = get_detective_list_graphs_response
+    mock_clients["bedrock"].invoke_model.side_effect = ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeModel"
+    )
+    mock_clients["scheduler"].create_schedule.side_effect = ClientError(
+        {"Error": {"Code": "ValidationException", "Message": "Invalid RoleArn"}}, "CreateSchedule"
+    )
+    event = {
+        "Records": [{"messageId": "message-1", "body": orjson.dumps(get_guardduty_event).decode()}]
+    }
+    response = index.lambda_handler(event, lambda_context)
+    assertpy.assert_that(response).is_equal_to(
+        {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+    )
+    mock_clients["scheduler"].create_schedule.assert_called_once()
+    mock_clients["s3"].put_object.assert_not_called()
+    mock_clients["s3"].generate_presigned_url.assert_not_called()
+    mock_clients["sns"].publish_batch.assert_not_called()
+    mock_clients["sns"].publish.assert_not_called()
@@ -1,7 +1,23 @@
 """
 File for storing constants used throughout the code
 """
+
 TAGS = []
-BEDROCK_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+BEDROCK_FOUNDATION_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+# Geography of the cross-region inference profile, prefixed to the foundation model id, for each
+# region the profiles route requests from. The bedrock_inference_profile_geo context overrides it
+BEDROCK_INFERENCE_PROFILE_GEOS = {
+    "us-east-1": "us",
+    "us-east-2": "us",
+    "us-west-2": "us",
+    "eu-central-1": "eu",
+    "eu-west-1": "eu",
+    "eu-west-3": "eu",
+    "ap-northeast-1": "apac",
+    "ap-northeast-2": "apac",
+    "ap-south-1": "apac",
+    "ap-southeast-1": "apac",
+    "ap-southeast-2": "apac",
+}
 LAMBDA_PILLOW_LAYER = "arn:aws:lambda:us-east-1:770693421928:layer:Klayers-p312-Pillow:3"
 ANTROPIC_VERSION = "bedrock-2023-05-31"
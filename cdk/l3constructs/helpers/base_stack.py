@@ -15,8 +15,14 @@ class BaseStack(Stack):
     adds custom logic to it, to meet project requirements.
     """
 
+    # Shared by all stacks of the app, so the environment and qualifier are only resolved once
+    helper = None
+
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
-        helper = Helper(tags=constants.TAGS)
+        # Created by the first stack, so the environment is read when the app is built
+        if BaseStack.helper is None:
+            BaseStack.helper = Helper(tags=constants.TAGS)
+        helper = BaseStack.helper
 
         cdk_env = helper.get_cdk_env()
         qualifier = helper.get_qualifier()
@@ -4,13 +4,124 @@ Helper module to be used in other projects to
 e.g. generate qualifiers or retrieve repository information
 """
 
+import functools
 import hashlib
 import json
 import os
 from pathlib import Path
 
 import cdk_nag
-from pygit2 import Repository
+
+# cdk.json is located in the root of the CDK app, three levels above this module
+CDK_CONTEXT_FILE = Path(__file__).resolve().parents[2] / "cdk.json"
+
+
+@functools.lru_cache(maxsize=None)
+def _open_repository(path: str):
+    """
+    Open the git repository of a path once per process,
+    so all stacks of an app share it. pygit2 is only imported
+    when the repository information is actually needed
+
+    :param path: path inside of the repository
+    :return: repository: pygit2.Repository or None if pygit2 is not installed
+    """
+    try:
+        from pygit2 import Repository
+    except ImportError:
+        return None
+    return Repository(path)
+
+
+def _find_git_dir(path: str) -> Path:
+    """
+    Find the .git directory of the repository containing a path
+
+    :param path: path inside of the repository
+    :return: path of the .git directory: Path
+    """
+    for directory in (Path(path).resolve(), *Path(path).resolve().parents):
+        git_path = directory / ".git"
+        if git_path.is_dir():
+            return git_path
+        if git_path.is_file():
+            # Worktrees and submodules point to their git directory
+            with open(git_path, "r") as git_file:
+                return (directory / git_file.read().strip().split("gitdir: ", 1)[1]).resolve()
+    raise FileNotFoundError(f"No git repository found for {path}")
+
+
+@functools.lru_cache(maxsize=None)
+def _read_remote_url(path: str) -> str:
+    """
+    Read the url of the first remote of the repository containing a path
+
+    :param path: path inside of the repository
+    :return: remote url: str
+    """
+    repo = _open_repository(path)
+    if repo is not None:
+        return repo.remotes[0].url
+
+    git_dir = _find_git_dir(path)
+    # worktrees keep their config in the common git directory
+    if (git_dir / "commondir").is_file():
+        with open(git_dir / "commondir", "r") as commondir_file:
+            git_dir = (git_dir / commondir_file.read().strip()).resolve()
+    in_remote = False
+    with open(git_dir / "config", "r") as config_file:
+        for line in config_file:
+            line = line.strip()
+            if line.startswith("["):
+                in_remote = line.startswith("[remote ")
+            elif in_remote and line.partition("=")[0].strip() == "url":
+                return line.partition("=")[2].strip()
+    raise IndexError(f"No remote configured for {path}")
+
+
+@functools.lru_cache(maxsize=None)
+def _read_branch_name(path: str) -> str:
+    """
+    Read the currently checked out branch of the repository containing a path
+
+    :param path: path inside of the repository
+    :return: branch name: str
+    """
+    repo = _open_repository(path)
+    if repo is not None:
+        return repo.head.shorthand
+
+    with open(_find_git_dir(path) / "HEAD", "r") as head_file:
+        head = head_file.read().strip()
+    # A detached HEAD holds a commit id, pygit2 names it HEAD
+    if not head.startswith("ref: "):
+        return "HEAD"
+    return head.removeprefix("ref: ").removeprefix("refs/heads/")
+
+
+@functools.lru_cache(maxsize=None)
+def _read_json(file_path: Path) -> dict:
+    """
+    Read a json file once per process
+
+    :param file_path: path of the json file
+    :return: dict of objects read from the file: dict
+    """
+    with open(file_path, "rb") as my_file:
+        return json.load(my_file)
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_qualifier(app_name: str) -> str:
+    """
+    Calculate the qualifier of an app name once per process
+
+    :param app_name: app name including the branch name
+    :return: qualifier: str
+    """
+    # Bootstrap qualifiers are limited to 10 characters and have to start with a letter
+    hashed_name = hashlib.blake2b(app_name.encode(), digest_size=5).hexdigest()
+    return f"q{hashed_name[:9]}"
 
 
 class Helper:
@@ -34,7 +145,15 @@ class Helper:
         self.prefix = prefix
         self.tags = tags
 
+        # Snapshot the overrides from the environment once
+        env = os.environ
+        self._env_cdk_env = env.get("CDK_ENV")
+        self._env_qualifier = env.get("QUALIFIER")
+        self._env_repo_name = env.get("REPO_NAME")
+        self._env_branch_name = env.get("BRANCH_NAME")
+
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def get_repo_name_from_url(url: str) -> str:
         """
         Retrieve repository name from repository url
@@ -42,15 +161,16 @@ class Helper:
         :param url: git branch url
         :return: repository name
         """
-        last_slash_index = max(url.rfind("/"), url.rfind("@"))
-        last_suffix_index = url.rfind(".git")
-        if last_suffix_index < 0:
-            last_suffix_index = len(url)
+        # The name follows the last "/", or the last "@" if that comes later
+        _, slash, tail = url.rpartition("/")
+        _, at, name = tail.rpartition("@")
+        if name.endswith(".git"):
+            name = name[:-4]
 
-        if last_slash_index < 0 or last_suffix_index <= last_slash_index:
+        if not (slash or at) or not name:
             raise Exception(f"Badly formatted url {url}")
 
-        return url[last_slash_index + 1 : last_suffix_index]
+        return name
 
     def get_repo_name_from_local_git(self):
         """
@@ -59,11 +179,10 @@ class Helper:
         :return: repository name
         """
         if self.repo_name is None:
-            if "REPO_NAME" in os.environ:
-                self.repo_name = os.environ["REPO_NAME"]
+            if self._env_repo_name is not None:
+                self.repo_name = self._env_repo_name
             else:
-                repo = Repository(os.getcwd())
-                self.repo_name = self.get_repo_name_from_url(repo.remotes[0].url)
+                self.repo_name = self.get_repo_name_from_url(_read_remote_url(os.getcwd()))
         return self.repo_name
 
     def get_branch_name_from_local_git(self) -> str:
@@ -74,11 +193,10 @@ class Helper:
         :return: string git branch
         """
         if self.branch_name is None:
-            if "BRANCH_NAME" in os.environ:
-                self.branch_name = os.environ["BRANCH_NAME"]
+            if self._env_branch_name is not None:
+                self.branch_name = self._env_branch_name
             else:
-                repo = Repository(os.getcwd())
-                self.branch_name = repo.head.shorthand
+                self.branch_name = _read_branch_name(os.getcwd())
         return self.branch_name
 
     def get_cdk_env(self):
@@ -88,8 +206,8 @@ class Helper:
         :return: environment: str
         """
         if self.cdk_env is None:
-            if "CDK_ENV" in os.environ:
-                self.cdk_env = os.environ["CDK_ENV"]
+            if self._env_cdk_env is not None:
+                self.cdk_env = self._env_cdk_env
             else:
                 self.repo_name = self.get_repo_name()
                 self.branch_name = self.get_repo_branch()
@@ -103,15 +221,11 @@ class Helper:
         :return: hashed_name: str
         """
         if self.qualifier is None:
-            if "QUALIFIER" in os.environ:
-                self.qualifier = os.environ["QUALIFIER"]
+            if self._env_qualifier is not None:
+                self.qualifier = self._env_qualifier
             else:
                 app_name = f"{self.get_cdk_app_name()}_{self.branch_name}"
-                hashed_name = hashlib.sha256(app_name.encode()).hexdigest()[:30]
-                index_first_non_numeric = hashed_name.find(next(filter(str.isalpha, hashed_name)))
-                self.qualifier = hashed_name[
-                    index_first_non_numeric : (10 + index_first_non_numeric)
-                ]
+                self.qualifier = _hash_qualifier(app_name)
         return self.qualifier
 
     def append_qualifier(self, name: str) -> str:
@@ -148,34 +262,13 @@ class Helper:
             self.get_repo_name_from_local_git()
         return self.repo_name
 
-    @staticmethod
-    def find_cdk(name: str, path: str):
-        """
-        Find a file in a given path
-        :param name: file name to look for
-        :param path: path in which to look for the file
-        :return: returns path of the file location
-        """
-        for root, dirs, files in os.walk(path):
-            if name in files:
-                return os.path.join(root, name)
-
     def read_cdk_context_json(self) -> dict:
         """
         Read cdk.json context file
 
         :return: dict of objects read from cdk.json: dict
         """
-        try:
-            file_path = self.find_cdk("cdk.json", Path(__file__).absolute().parent.parent.parent)
-        except FileNotFoundError:
-            print("File was not found")
-
-        with open(file_path, "r") as my_file:
-            data = my_file.read()
-
-        obj = json.loads(data)
-        return obj
+        return _read_json(CDK_CONTEXT_FILE)
 
     def get_cdk_app_name(self) -> str:
         """
@@ -1,5 +1,8 @@
+import functools
+import os
 from typing import List, Mapping, Optional
 
+import aws_cdk
 from aws_cdk import Duration
 from aws_cdk import aws_ec2 as ec2
 from aws_cdk import aws_iam as iam
@@ -7,6 +10,19 @@ from aws_cdk import aws_kms as kms
 from aws_cdk import aws_lambda as lambda_
 from constructs import Construct
 
+# Build artifacts are regenerated from the sources, so they don't change the asset hash
+ASSET_HASH_EXCLUDE = ["**/__pycache__", "**/*.pyc", "**/.venv", "**/node_modules", "target/"]
+
+
+def fingerprint_asset(lambda_root: str) -> str:
+    """Return the asset hash of a Lambda code directory, computed once per synth."""
+    return _fingerprint(os.path.realpath(lambda_root))
+
+
+@functools.lru_cache(maxsize=None)
+def _fingerprint(path: str) -> str:
+    return aws_cdk.FileSystem.fingerprint(path, exclude=ASSET_HASH_EXCLUDE)
+
 
 class L3Lambda(lambda_.Function):
     def __init__(
@@ -17,6 +33,7 @@ class L3Lambda(lambda_.Function):
         code_path: Optional[str] = None,
         code: Optional[lambda_.Code] = None,
         runtime: Optional[lambda_.Runtime] = None,
+        architecture: Optional[lambda_.Architecture] = None,
         role: Optional[iam.Role] = None,
         vpc: Optional[str] = None,
         memory_size: int = 128,
@@ -31,6 +48,7 @@ class L3Lambda(lambda_.Function):
             scope=scope,
             id=id,
             runtime=runtime,
+            architecture=architecture,
             code=code or lambda_.Code.from_asset(code_path),
             handler=handler,
             role=role,
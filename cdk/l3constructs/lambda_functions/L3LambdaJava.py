@@ -1,5 +1,7 @@
+import logging
 import os
 import re
+import shutil
 import subprocess
 from typing import List, Mapping, Optional
 
@@ -10,22 +12,41 @@ from aws_cdk import aws_kms, aws_lambda
 from constructs import Construct
 from jsii import implements, member
 
-from .L3Lambda import L3Lambda
+from .L3Lambda import L3Lambda, fingerprint_asset
+
+# Separates the runtime name from its version, e.g. java21 becomes java:21
+RUNTIME_NAME_PATTERN = re.compile(r"([a-z_-]+)")
 
 
 @implements(aws_cdk.ILocalBundling)
 class MyLocalBundler:
-    def __init__(self, lambda_root: str) -> None:
+    def __init__(self, lambda_root: str, function_name: str) -> None:
         self._lambda_root = lambda_root
+        self._function_name = function_name
 
     @member(jsii_name="tryBundle")
     def try_bundle(self, output_dir: str, options: aws_cdk.BundlingOptions) -> bool:
-        if os.environ.get("OS", "") == "Windows_NT":
-            subprocess.run([f"cd {self._lambda_root}", "mvn clean install"])
-        else:
-            subprocess.run(
-                ["bash", "-c", " && ".join([f"cd {self._lambda_root}, mvn clean install"])]
+        # Build in the Lambda root without a shell, one thread per core. The executable is
+        # resolved first so mvn.cmd is found on Windows too
+        cmd = [shutil.which("mvn") or "mvn", "-q", "-T", "1C", "clean", "install"]
+        try:
+            result = subprocess.run(
+                cmd, cwd=self._lambda_root, capture_output=True, text=True, check=False
             )
+        except OSError as e:
+            logging.error(f"Error during bundling: {str(e)}")
+            return False
+        if result.returncode != 0:
+            logging.error(f"Command failed: {' '.join(cmd)}")
+            logging.error(f"Error output: {result.stdout}{result.stderr}")
+            return False
+
+        # The asset is the jar built by Maven, an empty output would deploy a function without code
+        jar_file = os.path.join(self._lambda_root, "target", f"{self._function_name}.jar")
+        if not os.path.isfile(jar_file):
+            logging.error(f"Build output not found: {jar_file}")
+            return False
+        shutil.copy2(jar_file, output_dir)
         return True
 
 
@@ -81,8 +102,8 @@ class L3LambdaJava(L3Lambda):
 
         with open(input_docker_file_path, "r") as docker_file_r:
             file = docker_file_r.read()
-            file_content = file.format(
-                **{"RUNTIME": re.sub(r"([a-z_-]+)", r"\g<1>:", runtime.to_string(), 1)}
+            file_content = file.replace(
+                "{RUNTIME}", RUNTIME_NAME_PATTERN.sub(r"\g<1>:", runtime.to_string(), count=1)
             )
 
         with open(output_docker_file_path, "w") as docker_file_w:
@@ -96,7 +117,7 @@ class L3LambdaJava(L3Lambda):
 
     @staticmethod
     def bundle_locally(lambda_root: str, runtime: aws_lambda.Runtime, function_name: str):
-        asset_hash = aws_cdk.FileSystem.fingerprint(lambda_root)
+        asset_hash = fingerprint_asset(lambda_root)
 
         current_dir = "."
         code = aws_lambda.Code.from_asset(
@@ -107,7 +128,7 @@ class L3LambdaJava(L3Lambda):
                     f"rsync -r {lambda_root}/target/{function_name}.jar"
                     f" /asset-output/{lambda_root}/"
                 ],
-                local=MyLocalBundler(lambda_root=lambda_root),
+                local=MyLocalBundler(lambda_root=lambda_root, function_name=function_name),
             ),
             asset_hash=asset_hash,
             asset_hash_type=aws_cdk.AssetHashType.CUSTOM,
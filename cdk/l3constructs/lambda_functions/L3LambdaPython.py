@@ -1,9 +1,9 @@
 import logging
 import os
-import platform
 import re
+import shutil
 import subprocess
-from typing import List, Mapping, Optional
+from typing import List, Mapping, Optional, Union
 
 import aws_cdk
 from aws_cdk import Duration, Stack
@@ -12,7 +12,13 @@ from aws_cdk import aws_kms, aws_lambda
 from constructs import Construct
 from jsii import implements, member
 
-from .L3Lambda import L3Lambda
+from .L3Lambda import L3Lambda, fingerprint_asset
+
+# Separates the runtime name from its version, e.g. python3.12 becomes python:3.12
+RUNTIME_NAME_PATTERN = re.compile(r"([a-z_-]+)")
+
+# The dependencies are installed for the platform of the function, not the one running the synth
+PIP_PLATFORMS = {"x86_64": "manylinux2014_x86_64", "arm64": "manylinux2014_aarch64"}
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -20,9 +26,40 @@ logging.basicConfig(level=logging.INFO)
 
 @implements(aws_cdk.ILocalBundling)
 class MyLocalBundler:
-    def __init__(self, lambda_root: str, app_root: str) -> None:
+    def __init__(
+        self,
+        lambda_root: str,
+        app_root: str,
+        runtime: aws_lambda.Runtime = aws_lambda.Runtime.PYTHON_3_12,
+        architecture: aws_lambda.Architecture = aws_lambda.Architecture.X86_64,
+    ) -> None:
         self._lambda_root = lambda_root
         self._app_root = app_root
+        self._runtime = runtime
+        self._architecture = architecture
+
+    def pip_install_command(self, requirements_file: str, target_dir: str) -> List[str]:
+        """Return the pip command installing the requirements for the runtime and architecture."""
+        # Compiled dependencies like orjson must match the ABI of the runtime, e.g. cp312. pip
+        # only installs for another platform with --no-deps or --only-binary=:all:, and fpdf has
+        # no wheel. So the dependencies are not resolved: the requirements.txt of every function
+        # must pin all its transitive dependencies, a missing one fails at import time
+        return [
+            "pip",
+            "install",
+            "-r",
+            requirements_file,
+            "-t",
+            target_dir,
+            "--platform",
+            PIP_PLATFORMS[self._architecture.name],
+            "--implementation",
+            "cp",
+            "--python-version",
+            self._runtime.name.removeprefix("python"),
+            "--no-deps",
+            "--prefer-binary",
+        ]
 
     @member(jsii_name="tryBundle")
     def try_bundle(self, output_dir: str, options: aws_cdk.BundlingOptions) -> bool:
@@ -30,47 +67,29 @@ class MyLocalBundler:
             target_dir = os.path.join(output_dir)
             source_dir = os.path.abspath(self._lambda_root)
 
-            # Create commands list based on OS
-            if platform.system() == "Windows":
-                commands = [
-                    [
-                        "pip",
-                        "install",
-                        "-r",
-                        os.path.join(self._lambda_root, "requirements.txt"),
-                        "-t",
-                        target_dir,
-                    ],
-                    ["xcopy", "/E", "/I", "/Y", source_dir, target_dir],
-                ]
-            else:
-                commands = [
-                    [
-                        "pip",
-                        "install",
-                        "-U",
-                        "-r",
-                        os.path.join(self._lambda_root, "requirements.txt"),
-                        "-t",
-                        target_dir,
-                    ],
-                    ["rsync", "-a", f"{source_dir}/", f"{target_dir}/"],
-                ]
-
-            # Execute commands using list format (more secure than shell=True)
-            for cmd in commands:
-                result = subprocess.run(
-                    cmd,
-                    capture_output=True,
-                    text=True,
-                    check=False,
-                )
-                logging.info(f"Result: {result}")
-                if result.returncode != 0:
-                    logging.error(f"Command failed: {' '.join(cmd)}")
-                    logging.error(f"Error output: {result.stderr}")
-                    return False
-                logging.info(f"Command output: {result.stdout}")
+            requirements_file = os.path.join(self._lambda_root, "requirements.txt")
+            # Execute command using list format (more secure than shell=True)
+            cmd = self.pip_install_command(requirements_file, target_dir)
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                check=False,
+            )
+            logging.info(f"Result: {result}")
+            if result.returncode != 0:
+                logging.error(f"Command failed: {' '.join(cmd)}")
+                logging.error(f"Error output: {result.stderr}")
+                return False
+            logging.info(f"Command output: {result.stdout}")
+
+            # Copy the sources in process, bytecode is regenerated by the Lambda runtime
+            shutil.copytree(
+                source_dir,
+                target_dir,
+                dirs_exist_ok=True,
+                ignore=shutil.ignore_patterns("__pycache__", "*.pyc", ".venv"),
+            )
 
             logging.info("Bundling completed successfully")
             return True
@@ -85,9 +104,10 @@ class L3LambdaPython(L3Lambda):
         self,
         scope: Construct,
         id: str,
-        code: str,
+        code: Union[str, aws_lambda.Code],
         handler: str,
         runtime: aws_lambda.Runtime = aws_lambda.Runtime.PYTHON_3_12,
+        architecture: aws_lambda.Architecture = aws_lambda.Architecture.X86_64,
         role: Optional[iam.Role] = None,
         vpc: Optional[str] = None,
         environment: Optional[Mapping] = None,
@@ -98,12 +118,19 @@ class L3LambdaPython(L3Lambda):
         memory: int = 128,
         timeout: Duration = Duration.seconds(60),
     ):
+        # A code directory is bundled with its requirements, ready made code is used as is
+        if isinstance(code, str):
+            code = L3LambdaPython.bundle_locally(
+                app_root="", lambda_root=code, runtime=runtime, architecture=architecture
+            )
+
         super(L3LambdaPython, self).__init__(
             scope=scope,
             id=id,
-            code=L3LambdaPython.bundle_locally(app_root="", lambda_root=code, runtime=runtime),
+            code=code,
             handler=handler,
             runtime=runtime or None,
+            architecture=architecture,
             role=role or None,
             vpc=vpc or None,
             description=description or None,
@@ -129,8 +156,8 @@ class L3LambdaPython(L3Lambda):
 
         with open(input_docker_file_path, "r") as docker_file_r:
             file = docker_file_r.read()
-            file_content = file.format(
-                **{"RUNTIME": re.sub(r"([a-z_-]+)", r"\g<1>:", runtime.to_string(), 1)}
+            file_content = file.replace(
+                "{RUNTIME}", RUNTIME_NAME_PATTERN.sub(r"\g<1>:", runtime.to_string(), count=1)
             )
 
         with open(output_docker_file_path, "w") as docker_file_w:
@@ -143,17 +170,25 @@ class L3LambdaPython(L3Lambda):
         return docker_build
 
     @staticmethod
-    def bundle_locally(app_root: str, lambda_root: str, runtime: aws_lambda.Runtime):
-        hash_path = lambda_root
-
-        asset_hash = aws_cdk.FileSystem.fingerprint(hash_path)
+    def bundle_locally(
+        app_root: str,
+        lambda_root: str,
+        runtime: aws_lambda.Runtime,
+        architecture: aws_lambda.Architecture = aws_lambda.Architecture.X86_64,
+    ):
+        asset_hash = fingerprint_asset(lambda_root)
 
         code = aws_lambda.Code.from_asset(
             path=lambda_root,
             bundling=aws_cdk.BundlingOptions(
                 image=runtime.bundling_image,
                 command=["bash", "-c", f"rsync -r {lambda_root} /asset-output/{app_root}/"],
-                local=MyLocalBundler(lambda_root=lambda_root, app_root=app_root),
+                local=MyLocalBundler(
+                    lambda_root=lambda_root,
+                    app_root=app_root,
+                    runtime=runtime,
+                    architecture=architecture,
+                ),
             ),
             asset_hash=asset_hash,
             asset_hash_type=aws_cdk.AssetHashType.CUSTOM,
@@ -1,22 +1,90 @@
-import os
+from pathlib import Path
+from typing import Optional
 
 import cdk_nag
 import constants
+from aws_cdk import CfnMapping, Duration, Stack, Token
 from aws_cdk import aws_events as events
 from aws_cdk import aws_events_targets as targets
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_kms as kms
+from aws_cdk import aws_lambda
+from aws_cdk import aws_lambda_event_sources as lambda_event_sources
+from aws_cdk import aws_s3 as s3
+from aws_cdk import aws_s3_notifications as s3n
 from aws_cdk import aws_sns as sns
+from aws_cdk import aws_sqs as sqs
 from constructs import Construct
 from l3constructs.helpers.base_stack import BaseStack
 from l3constructs.lambda_functions.L3LambdaPython import L3LambdaPython
 from l3constructs.s3.l3_bucket import L3S3Bucket
 
+# Path to the code of the Lambda functions, resolved once at import time
+LAMBDA_CODE_PATH = str(Path(__file__).resolve().parents[2] / "app" / "ai_generator")
+
+
+def bedrock_inference_profile_geo(stack: Stack) -> str:
+    """Return the geography of the Bedrock cross-region inference profile for the stack region.
+
+    The bedrock_inference_profile_geo context takes precedence. Environment agnostic stacks look
+    the geography up at deploy time, unsupported regions fail the synth or the deployment.
+    """
+    geo = stack.node.try_get_context("bedrock_inference_profile_geo")
+    if geo:
+        return geo
+    region = stack.region
+    if Token.is_unresolved(region):
+        geos = CfnMapping(
+            stack,
+            "BedrockInferenceProfileGeos",
+            mapping={
+                region_name: {"geo": geo}
+                for region_name, geo in constants.BEDROCK_INFERENCE_PROFILE_GEOS.items()
+            },
+        )
+        return geos.find_in_map(region, "geo")
+    if region not in constants.BEDROCK_INFERENCE_PROFILE_GEOS:
+        raise ValueError(
+            f"No Bedrock cross-region inference profile routes requests from {region}, set the"
+            " bedrock_inference_profile_geo context to the geography of the profile to use"
+        )
+    return constants.BEDROCK_INFERENCE_PROFILE_GEOS[region]
+
 
 class AISecurityRecommendations(BaseStack):
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: Construct,
+        construct_id: str,
+        lambda_code: Optional[aws_lambda.Code] = None,
+        **kwargs,
+    ) -> None:
+        """Create the stack, lambda_code replaces the bundled app/ai_generator code if given."""
         super().__init__(scope, construct_id, **kwargs)
 
+        # Every access to the stack region and account is a call into the jsii runtime, so the
+        # ARNs built from them are computed once
+        region = self.region
+        account = self.account
+        # Bedrock routes the requests of the profile across the regions of its geography
+        bedrock_model_id = (
+            f"{bedrock_inference_profile_geo(self)}.{constants.BEDROCK_FOUNDATION_MODEL_ID}"
+        )
+        bedrock_inference_profile_arn = (
+            f"arn:aws:bedrock:{region}:{account}:inference-profile/{bedrock_model_id}"
+        )
+        bedrock_foundation_model_arn = (
+            f"arn:aws:bedrock:*::foundation-model/{constants.BEDROCK_FOUNDATION_MODEL_ID}"
+        )
+        retry_schedule_arn = (
+            f"arn:aws:scheduler:{region}:{account}:schedule/default/RetryLambdaInvocation-*"
+        )
+        guardduty_detector_arn = f"arn:aws:guardduty:{region}:{account}:detector/*"
+
+        # A batch of up to 10 findings is processed concurrently, each with its own Bedrock call.
+        # The timeout covers the worst case of the client timeouts and retries of index.py
+        lambda_timeout = Duration.minutes(5)
+
         # Instantiate the L3 S3 bucket with loggin enabled
         bucket_construct = L3S3Bucket(
             self,
@@ -32,7 +100,9 @@ class AISecurityRecommendations(BaseStack):
         # create the SNS topic for the notifications
         # Create a KMS key for encryption
         self.topic_encryption_key = kms.Key(
-            self, f"{id}Key", enable_key_rotation=True  # Enable key rotation for added security
+            self,
+            "TopicEncryptionKey",
+            enable_key_rotation=True,  # Enable key rotation for added security
         )
         self.topic = sns.Topic(
             self,
@@ -43,158 +113,284 @@ class AISecurityRecommendations(BaseStack):
             master_key=self.topic_encryption_key,
         )
 
-        # event bridge rule to trigger the lambda based on guardduty event
+        # event bridge rule to trigger the lambda based on guardduty event, low severity findings
+        # and findings of other regions are filtered out by EventBridge and never reach the lambda
         self.rule = events.Rule(
             self,
             "AiSecurityRecommendationsRule",
             event_pattern=events.EventPattern(
-                source=["aws.guardduty"], detail_type=["GuardDuty Finding"]
+                source=["aws.guardduty"],
+                detail_type=["GuardDuty Finding"],
+                detail={"severity": [{"numeric": [">=", 4]}], "region": [region]},
+            ),
+        )
+
+        # The findings are buffered in a queue, so the Lambda function processes them in batches
+        self.findings_dead_letter_queue = sqs.Queue(
+            self,
+            "FindingsDeadLetterQueue",
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+        )
+        self.findings_queue = sqs.Queue(
+            self,
+            "FindingsQueue",
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            # Six times the timeout of the function as recommended for SQS event sources, so a
+            # batch still being processed or retried by the poller is not delivered again
+            visibility_timeout=Duration.seconds(6 * lambda_timeout.to_seconds()),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3, queue=self.findings_dead_letter_queue
             ),
         )
 
+        # Both Lambda functions roles are assumed by the same service principal
+        lambda_principal = iam.ServicePrincipal("lambda.amazonaws.com")
+
         # Create a custom IAM role for the Lambda function
-        self.lambda_role = iam.Role(
-            self, "LambdaExecutionRole", assumed_by=iam.ServicePrincipal("lambda.amazonaws.com")
+        self.lambda_role = iam.Role(self, "LambdaExecutionRole", assumed_by=lambda_principal)
+
+        # Create the role used by EventBridge Scheduler to invoke the Lambda function on retries
+        self.retry_scheduler_role = iam.Role(
+            self, "RetrySchedulerRole", assumed_by=iam.ServicePrincipal("scheduler.amazonaws.com")
         )
 
-        # Create the Lambda function using the L3 construct
-        self.lambda_function = L3LambdaPython(
+        # All the permissions of the Lambda function are authored as a single policy document, so
+        # the synthesized template has no default inline policy growing with every grant and no
+        # statement objects are built through jsii
+        policy_document = {
+            "Version": "2012-10-17",
+            "Statement": [
+                # Grant write, read access to the bucket to store the pdf and generate the
+                # pre-signed link
+                {
+                    "Action": ["s3:PutObject", "s3:GetObject", "s3:ListBucket"],
+                    "Effect": "Allow",
+                    "Resource": [
+                        self.reports_bucket.bucket_arn,
+                        self.reports_bucket.bucket_arn + "/*",
+                    ],
+                },
+                # Grant sns Publish access to the lambda function role, the reports are only
+                # generated and notified if the topic has confirmed subscriptions
+                {
+                    "Action": ["sns:Publish", "sns:GetTopicAttributes"],
+                    "Effect": "Allow",
+                    "Resource": self.topic.topic_arn,
+                },
+                # Grant read access to the GuardDuty findings of the detectors in the region
+                {
+                    "Action": ["guardduty:GetFindings", "guardduty:ListFindings"],
+                    "Effect": "Allow",
+                    "Resource": guardduty_detector_arn,
+                },
+                # guardduty:ListDetectors and the detective list actions do not support resource
+                # level permissions
+                {
+                    "Action": [
+                        "guardduty:ListDetectors",
+                        "detective:ListGraphs",
+                        "detective:GetMembers",
+                        "detective:ListDatasourcePackages",
+                        "detective:ListActivities",
+                        "detective:ListMembers",
+                    ],
+                    "Effect": "Allow",
+                    "Resource": "*",
+                },
+                # lets grant permission to invoke the bedrock model through the inference
+                # profile, which can route the request to the foundation model in any of its
+                # regions. Bedrock evaluates both ARNs, the profile and the foundation model
+                {
+                    "Action": "bedrock:InvokeModel",
+                    "Effect": "Allow",
+                    "Resource": [bedrock_inference_profile_arn, bedrock_foundation_model_arn],
+                },
+                # grant permissions to schedule a one-time retry in case of throttling, the
+                # schedules delete themselves once they ran
+                {
+                    "Action": "scheduler:CreateSchedule",
+                    "Effect": "Allow",
+                    "Resource": retry_schedule_arn,
+                },
+                {
+                    "Action": "iam:PassRole",
+                    "Condition": {
+                        "StringEquals": {"iam:PassedToService": "scheduler.amazonaws.com"}
+                    },
+                    "Effect": "Allow",
+                    "Resource": self.retry_scheduler_role.role_arn,
+                },
+                # Grant access to consume the GuardDuty findings from the queue
+                {
+                    "Action": [
+                        "sqs:ReceiveMessage",
+                        "sqs:ChangeMessageVisibility",
+                        "sqs:GetQueueUrl",
+                        "sqs:DeleteMessage",
+                        "sqs:GetQueueAttributes",
+                    ],
+                    "Effect": "Allow",
+                    "Resource": self.findings_queue.queue_arn,
+                },
+            ],
+        }
+        self.lambda_policy = iam.CfnManagedPolicy(
             self,
-            "L3LambdaPython",
-            code=os.path.join(
-                os.path.dirname(__file__), "..", "..", "app", "ai_generator"
-            ),  # Path to Lambda code
-            handler="index.lambda_handler",  # Lambda entry point
-            role=self.lambda_role,  # Set the custom role
-            # layers=[constants.LAMBDA_PILLOW_LAYER],
-            environment={
-                "AI_REPORTS_BUCKET_NAME": self.reports_bucket.bucket_name,
-                "AI_REPORTS_TOPIC_ARN": self.topic.topic_arn,
-                "BEDROCK_MODEL_ID": constants.BEDROCK_MODEL_ID,
-                "body_args_anthropic_version": constants.ANTROPIC_VERSION,
-            },
+            "LambdaPolicy",
+            policy_document=policy_document,
+            roles=[self.lambda_role.role_name],
         )
-
-        # # Grant write access to the Lambda function for the S3 bucket
-        self.reports_bucket.grant_write(self.lambda_function.role)
-        self.lambda_function.role.add_managed_policy(
+        self.lambda_role.add_managed_policy(
             iam.ManagedPolicy.from_aws_managed_policy_name(
                 "service-role/AWSLambdaBasicExecutionRole"
             )
         )
 
-        # add cdk_nag exclusion for lambda role resource
-        # Suppress the AWS managed policy warning
+        # self.topic.grant_publish(self.lambda_function.role) permissions are to wide for this,
+        # the key policy allows the role to encrypt the messages published to the topic
+        self.topic_encryption_key.add_to_resource_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                principals=[self.lambda_role],
+                actions=["kms:Decrypt", "kms:GenerateDataKey*"],
+                resources=["*"],
+            )
+        )
+
+        # add cdk_nag exclusion for lambda role and policy resources
+        # Suppress the AWS managed policy and wildcard permissions warnings
         cdk_nag.NagSuppressions.add_resource_suppressions(
-            self.lambda_role,
+            [self.lambda_role, self.lambda_policy],
             [
                 cdk_nag.NagPackSuppression(
                     id="AwsSolutions-IAM4",
                     reason="Managed Policies are for service account roles only",
-                )
-            ],
-            apply_to_children=True,
-        )
-
-        cdk_nag.NagSuppressions.add_resource_suppressions(
-            self.lambda_role,
-            [
+                ),
                 cdk_nag.NagPackSuppression(
                     id="AwsSolutions-IAM5",
-                    reason="Managed Policies are for service account roles only",
-                )
+                    reason=(
+                        "guardduty:ListDetectors and the Detective list actions do not support "
+                        "resource level permissions, the other wildcards are scoped to the "
+                        "report objects, the detectors and the retry schedules of the stack "
+                        "account and region and to the foundation model regions of the "
+                        "inference profile"
+                    ),
+                ),
             ],
             apply_to_children=True,
         )
 
-        # Grant write, read access to the bucket to store the pdf and generate the pre-signed link
-        self.lambda_function.role.add_to_policy(
+        # Both Lambda functions share the code of app/ai_generator
+        lambda_code = lambda_code or LAMBDA_CODE_PATH
+
+        # Create the Lambda function using the L3 construct, the grants of the L3 construct and
+        # its event sources are already covered by the managed policy
+        self.lambda_function = L3LambdaPython(
+            self,
+            "L3LambdaPython",
+            code=lambda_code,  # Path to Lambda code
+            handler="index.lambda_handler",  # Lambda entry point
+            role=self.lambda_role.without_policy_updates(),  # Set the custom role
+            timeout=lambda_timeout,
+            memory=512,
+            # layers=[constants.LAMBDA_PILLOW_LAYER],
+            environment={
+                "AI_REPORTS_BUCKET_NAME": self.reports_bucket.bucket_name,
+                "AI_REPORTS_TOPIC_ARN": self.topic.topic_arn,
+                "BEDROCK_MODEL_ID": bedrock_model_id,
+                "RETRY_SCHEDULER_ROLE_ARN": self.retry_scheduler_role.role_arn,
+                "body_args_anthropic_version": constants.ANTROPIC_VERSION,
+            },
+        )
+        # The event source mapping checks the queue permissions of the role on creation
+        self.lambda_function.node.add_dependency(self.lambda_policy)
+        # Allow the retry schedules to invoke the Lambda function
+        self.retry_scheduler_role.add_to_policy(
             iam.PolicyStatement(
                 effect=iam.Effect.ALLOW,
-                actions=["s3:PutObject", "s3:GetObject", "s3:ListBucket"],
-                resources=[self.reports_bucket.bucket_arn, self.reports_bucket.bucket_arn + "/*"],
+                actions=["lambda:InvokeFunction"],
+                resources=[self.lambda_function.function_arn],
             )
         )
-
-        # Grant publish access to the SNS topic
-        # self.topic.grant_publish(self.lambda_function.role) permissions are to wide for this
-        self.topic.add_to_resource_policy(
-            iam.PolicyStatement(
-                effect=iam.Effect.ALLOW,
-                principals=[iam.ServicePrincipal("lambda.amazonaws.com")],
-                actions=["sns:Publish"],
-                resources=[self.topic.topic_arn],
-                conditions={"ArnEquals": {"aws:SourceArn": self.lambda_function.function_arn}},
+        # lets connect event bridge rule to the lambda function through the findings queue
+        self.rule.add_target(targets.SqsQueue(self.findings_queue))
+        self.lambda_function.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                self.findings_queue,
+                batch_size=10,
+                max_batching_window=Duration.seconds(5),
+                report_batch_item_failures=True,
             )
         )
-        self.topic_encryption_key.grant_encrypt_decrypt(self.lambda_function.role)
 
-        # Grant sns Publish access to the lambda function role
-        self.lambda_function.role.add_to_policy(
-            iam.PolicyStatement(
-                effect=iam.Effect.ALLOW, actions=["sns:Publish"], resources=[self.topic.topic_arn]
+        # Create a custom IAM role for the PDF generation Lambda function
+        self.pdf_lambda_role = iam.Role(self, "PdfLambdaExecutionRole", assumed_by=lambda_principal)
+        self.pdf_lambda_role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name(
+                "service-role/AWSLambdaBasicExecutionRole"
             )
         )
 
-        # Grant Guardduty access to the lambda function role
-        self.lambda_function.role.add_to_policy(
-            iam.PolicyStatement(
-                effect=iam.Effect.ALLOW,
-                actions=[
-                    "guardduty:GetFindings",
-                    "guardduty:ListDetectors",
-                    "guardduty:ListFindings",
-                ],
-                resources=["arn:aws:guardduty:*:*:detector/*"],
-            )
+        # The PDF reports are generated out of the critical path, from the AI insights stored
+        # by the main Lambda function
+        self.pdf_lambda_function = L3LambdaPython(
+            self,
+            "L3LambdaPythonPdf",
+            code=lambda_code,  # Path to Lambda code
+            handler="index.pdf_handler",  # Lambda entry point
+            role=self.pdf_lambda_role,  # Set the custom role
         )
-        # Grant Permissions to query detective
-        self.lambda_function.role.add_to_policy(
+
+        # Grant read access to the AI insights and write access to the pdf reports
+        self.pdf_lambda_role.add_to_policy(
             iam.PolicyStatement(
                 effect=iam.Effect.ALLOW,
-                actions=[
-                    "detective:ListGraphs",
-                    "detective:GetMembers",
-                    "detective:ListDatasourcePackages",
-                    "detective:ListActivities",
-                    "detective:ListMembers",
-                ],
-                resources=["*"],
+                actions=["s3:GetObject"],
+                resources=[self.reports_bucket.arn_for_objects("insights/*")],
             )
         )
-        # lets grant permission to invoke the bedrock model
-        self.lambda_function.role.add_to_policy(
+        self.pdf_lambda_role.add_to_policy(
             iam.PolicyStatement(
                 effect=iam.Effect.ALLOW,
-                actions=["bedrock:InvokeModel"],
-                resources=[
-                    f"arn:aws:bedrock:{self.region}::model/{constants.BEDROCK_MODEL_ID}",
-                    f"arn:aws:bedrock:{self.region}::foundation-model/{constants.BEDROCK_MODEL_ID}",
-                ],
+                actions=["s3:PutObject"],
+                resources=[self.reports_bucket.arn_for_objects("*.pdf")],
             )
         )
-        # grant permissions to reschedule an event in case of throttling
-        self.lambda_function.role.add_to_policy(
-            iam.PolicyStatement(
-                effect=iam.Effect.ALLOW,
-                actions=[
-                    "events:PutRule",
-                    "events:PutTargets",
-                    "events:DeleteRule",
-                    "events:RemoveTargets",
-                ],
-                resources=[
-                    f"arn:aws:events:{self.region}:{self.account}:rule/RetryLambdaInvocation-*"
-                ],
-            )
+        cdk_nag.NagSuppressions.add_resource_suppressions(
+            self.pdf_lambda_role,
+            [
+                cdk_nag.NagPackSuppression(
+                    id="AwsSolutions-IAM4",
+                    reason="Managed Policies are for service account roles only",
+                ),
+                cdk_nag.NagPackSuppression(
+                    id="AwsSolutions-IAM5",
+                    reason="Access is scoped to the insights and pdf report objects",
+                ),
+            ],
+            apply_to_children=True,
+        )
+
+        # Trigger the PDF generation whenever new AI insights are stored
+        self.reports_bucket.add_event_notification(
+            s3.EventType.OBJECT_CREATED,
+            s3n.LambdaDestination(self.pdf_lambda_function),
+            s3.NotificationKeyFilter(prefix="insights/", suffix=".json"),
         )
-        # grant invoke to sns event to trigger lambda function from resource arn:aws:events:*:{self.account}:rule/RetryLambdaInvocation-*
-        # Add permission for the Event Rule to invoke the Lambda function
-        self.lambda_function.add_permission(
-            "RetryEventsPermissions",
-            principal=iam.ServicePrincipal("events.amazonaws.com"),
-            action="lambda:InvokeFunction",
-            source_arn=f"arn:aws:events:{self.region}:{self.account}:rule/RetryLambdaInvocation-*",
+        cdk_nag.NagSuppressions.add_resource_suppressions_by_path(
+            self,
+            f"/{self.stack_name}/BucketNotificationsHandler050a0587b7544547bf325f094a3db834/Role",
+            [
+                cdk_nag.NagPackSuppression(
+                    id="AwsSolutions-IAM4",
+                    reason="CDK managed handler for the S3 bucket notifications",
+                ),
+                cdk_nag.NagPackSuppression(
+                    id="AwsSolutions-IAM5",
+                    reason="CDK managed handler for the S3 bucket notifications",
+                ),
+            ],
+            apply_to_children=True,
         )
-        # lets connect event bridge rule to the lambda function
-        self.rule.add_target(targets.LambdaFunction(self.lambda_function))
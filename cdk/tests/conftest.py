@@ -0,0 +1,78 @@
+import hashlib
+import os
+from importlib import metadata
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+# The synthesized template only depends on these sources, the libraries and the environment
+TEMPLATE_SOURCES = [
+    "cdk/cdk.json",
+    "cdk/constants.py",
+    "cdk/stacks/**/*.py",
+    "cdk/l3constructs/**/*.py",
+    "cdk/tests/conftest.py",
+    "app/ai_generator/**/*",
+]
+TEMPLATE_DISTRIBUTIONS = ["aws-cdk-lib", "cdk-nag", "constructs", "jsii"]
+TEMPLATE_ENVIRONMENT = ["CDK_ENV", "QUALIFIER", "REPO_NAME", "BRANCH_NAME"]
+# Reusing the template of a previous session skips the stack construction and its errors, so
+# the cache is only used when it is explicitly enabled
+TEMPLATE_CACHE_ENABLED = bool(os.environ.get("CDK_TEST_TEMPLATE_CACHE"))
+TEMPLATE_CACHE_KEY = "ai_sec_reco/template"
+# The tests only assert on the synthesized template, the Lambda functions get this inline code
+# instead of the bundled app/ai_generator asset
+TEST_LAMBDA_CODE = (
+    "def lambda_handler(event, context):\n    pass\n\n\npdf_handler = lambda_handler\n"
+)
+
+
+def template_cache_key() -> str:
+    """Return a hash of everything the synthesized template depends on."""
+    digest = hashlib.sha256()
+    for name in TEMPLATE_DISTRIBUTIONS:
+        digest.update(f"\0{name}=={metadata.version(name)}".encode())
+    for name in TEMPLATE_ENVIRONMENT:
+        digest.update(f"\0{name}={os.environ.get(name)}".encode())
+    for pattern in TEMPLATE_SOURCES:
+        for path in sorted(REPO_ROOT.glob(pattern)):
+            if not path.is_file() or "__pycache__" in path.parts:
+                continue
+            digest.update(f"\0{path.relative_to(REPO_ROOT)}\0".encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+# Synthesize the stack once per test session, the template is read-only so it can be shared.
+# The stack is imported when a test first needs it, not when the tests are collected. With
+# CDK_TEST_TEMPLATE_CACHE set, the template of unchanged inputs is loaded from the pytest cache
+@pytest.fixture(scope="session")
+def load_stack(request):
+    from aws_cdk import assertions
+
+    if TEMPLATE_CACHE_ENABLED:
+        cache_key = template_cache_key()
+        cached = request.config.cache.get(TEMPLATE_CACHE_KEY, None)
+        if cached and cached["key"] == cache_key:
+            return assertions.Template.from_json(cached["template"])
+
+    from aws_cdk import App, aws_lambda
+    from l3constructs.helpers.helper import Helper
+    from stacks.ai_security_recommendations import AISecurityRecommendations
+
+    app = App()
+    Helper(tags={}, prefix="")
+    stack = AISecurityRecommendations(
+        app,
+        "AISecurityRecommendations",
+        lambda_code=aws_lambda.Code.from_inline(TEST_LAMBDA_CODE),
+        env={"region": "us-east-1"},
+    )
+    template = assertions.Template.from_stack(stack)
+
+    if TEMPLATE_CACHE_ENABLED:
+        request.config.cache.set(
+            TEMPLATE_CACHE_KEY, {"key": cache_key, "template": template.to_json()}
+        )
+    return template
@@ -1,15 +1,7 @@
+import constants
 import pytest
-from aws_cdk import App, assertions
-from l3constructs.helpers.helper import Helper
-from stacks.ai_security_recommendations import AISecurityRecommendations
-
-
-@pytest.fixture(scope="module")
-def load_stack():
-    app = App()
-    Helper(tags={}, prefix="")
-    stack = AISecurityRecommendations(app, "AISecurityRecommendations", env={"region": "us-east-1"})
-    return assertions.Template.from_stack(stack)
+from aws_cdk import App, Stack, assertions
+from stacks.ai_security_recommendations import bedrock_inference_profile_geo
 
 
 # Test to check if the S3 bucket is created
@@ -33,7 +25,9 @@ def test_sns_topic_created_with_encryption(load_stack):
         "AWS::SNS::Topic",
         {
             "TopicName": "AiSecurityRecommendationsTopic",
-            "KmsMasterKeyId": assertions.Match.any_value(),
+            "KmsMasterKeyId": {
+                "Fn::GetAtt": [assertions.Match.string_like_regexp("^TopicEncryptionKey"), "Arn"]
+            },
         },
     )
 
@@ -42,7 +36,47 @@ def test_sns_topic_created_with_encryption(load_stack):
 def test_event_rule_created(load_stack):
     load_stack.has_resource_properties(
         "AWS::Events::Rule",
-        {"EventPattern": {"source": ["aws.guardduty"], "detail-type": ["GuardDuty Finding"]}},
+        {
+            "EventPattern": {
+                "source": ["aws.guardduty"],
+                "detail-type": ["GuardDuty Finding"],
+                "detail": {"severity": [{"numeric": [">=", 4]}], "region": ["us-east-1"]},
+            }
+        },
+    )
+
+
+# Test to check if the GuardDuty findings reach the Lambda function in batches through SQS
+def test_lambda_consumes_findings_queue(load_stack):
+    load_stack.has_resource_properties(
+        "AWS::Events::Rule",
+        {
+            "Targets": [
+                assertions.Match.object_like(
+                    {
+                        "Arn": {
+                            "Fn::GetAtt": [
+                                assertions.Match.string_like_regexp("FindingsQueue"),
+                                "Arn",
+                            ]
+                        }
+                    }
+                )
+            ]
+        },
+    )
+    # Six times the 300 seconds timeout of the function
+    load_stack.has_resource_properties(
+        "AWS::SQS::Queue",
+        {"VisibilityTimeout": 1800, "RedrivePolicy": assertions.Match.any_value()},
+    )
+    load_stack.has_resource_properties(
+        "AWS::Lambda::EventSourceMapping",
+        {
+            "BatchSize": 10,
+            "MaximumBatchingWindowInSeconds": 5,
+            "FunctionResponseTypes": ["ReportBatchItemFailures"],
+        },
     )
 
 
@@ -52,121 +86,162 @@ def test_lambda_function_created(load_stack):
         "AWS::Lambda::Function",
         {
             "Handler": "index.lambda_handler",
+            "Timeout": 300,
+            "MemorySize": 512,
             "Environment": {
                 "Variables": {
                     "AI_REPORTS_BUCKET_NAME": assertions.Match.any_value(),
                     "AI_REPORTS_TOPIC_ARN": assertions.Match.any_value(),
-                    "BEDROCK_MODEL_ID": assertions.Match.any_value(),
+                    "BEDROCK_MODEL_ID": f"us.{constants.BEDROCK_FOUNDATION_MODEL_ID}",
                 }
             },
         },
     )
 
 
-# Test to check if Lambda function has S3, SNS, and GuardDuty permissions
+# Test to check if the inference profile matches the geography of the deployment region
+def test_bedrock_inference_profile_geo():
+    assert bedrock_inference_profile_geo(Stack(App(), "Eu", env={"region": "eu-west-1"})) == "eu"
+    app = App(context={"bedrock_inference_profile_geo": "us"})
+    assert (
+        bedrock_inference_profile_geo(Stack(app, "Override", env={"region": "ca-central-1"}))
+        == "us"
+    )
+
+    # Environment agnostic stacks look the geography of the region up at deploy time
+    stack = Stack(App(), "Agnostic")
+    assert stack.resolve(bedrock_inference_profile_geo(stack)) == {
+        "Fn::FindInMap": ["BedrockInferenceProfileGeos", {"Ref": "AWS::Region"}, "geo"]
+    }
+
+    with pytest.raises(ValueError, match="sa-east-1"):
+        bedrock_inference_profile_geo(Stack(App(), "Unsupported", env={"region": "sa-east-1"}))
+
+
+# Test to check if Lambda function has S3, SNS, GuardDuty and rescheduling permissions,
+# the resources are looked up once and asserted on directly
 def test_lambda_has_required_permissions(load_stack):
-    expected_policy = {
-        "Statement": [
-            {
-                "Action": [
-                    "s3:DeleteObject*",
-                    "s3:PutObject",
-                    "s3:PutObjectLegalHold",
-                    "s3:PutObjectRetention",
-                    "s3:PutObjectTagging",
-                    "s3:PutObjectVersionTagging",
-                    "s3:Abort*",
-                ],
-                "Effect": "Allow",
-                "Resource": assertions.Match.any_value(),
-            },
-            {
-                "Action": ["s3:PutObject", "s3:GetObject", "s3:ListBucket"],
-                "Effect": "Allow",
-                "Resource": assertions.Match.any_value(),
-            },
-            {
-                "Action": ["kms:Decrypt", "kms:Encrypt", "kms:ReEncrypt*", "kms:GenerateDataKey*"],
-                "Effect": "Allow",
-                "Resource": assertions.Match.any_value(),
-            },
-            {"Action": "sns:Publish", "Effect": "Allow", "Resource": assertions.Match.any_value()},
-            {
-                "Action": [
-                    "guardduty:GetFindings",
-                    "guardduty:ListDetectors",
-                    "guardduty:ListFindings",
-                ],
-                "Effect": "Allow",
-                "Resource": "arn:aws:guardduty:*:*:detector/*",
-            },
-            {
-                "Action": [
-                    "detective:ListGraphs",
-                    "detective:GetMembers",
-                    "detective:ListDatasourcePackages",
-                    "detective:ListActivities",
-                    "detective:ListMembers",
-                ],
-                "Effect": "Allow",
-                "Resource": "*",
-            },
-            {
-                "Action": "bedrock:InvokeModel",
-                "Effect": "Allow",
-                "Resource": assertions.Match.any_value(),
-            },
-            {
-                "Action": [
-                    "events:PutRule",
-                    "events:PutTargets",
-                    "events:DeleteRule",
-                    "events:RemoveTargets",
-                ],
-                "Effect": "Allow",
-                "Resource": assertions.Match.any_value(),
-            },
+    lambda_role = {"Ref": "LambdaExecutionRoleD5C26073"}
+    expected_actions = [
+        ["s3:PutObject", "s3:GetObject", "s3:ListBucket"],
+        ["sns:Publish", "sns:GetTopicAttributes"],
+        ["guardduty:GetFindings", "guardduty:ListFindings"],
+        [
+            "guardduty:ListDetectors",
+            "detective:ListGraphs",
+            "detective:GetMembers",
+            "detective:ListDatasourcePackages",
+            "detective:ListActivities",
+            "detective:ListMembers",
         ],
-        "Version": "2012-10-17",
-    }
+        "bedrock:InvokeModel",
+        "scheduler:CreateSchedule",
+        "iam:PassRole",
+        [
+            "sqs:ReceiveMessage",
+            "sqs:ChangeMessageVisibility",
+            "sqs:GetQueueUrl",
+            "sqs:DeleteMessage",
+            "sqs:GetQueueAttributes",
+        ],
+    ]
 
-    load_stack.has_resource_properties(
-        "AWS::IAM::Policy",
+    policies = load_stack.find_resources(
+        "AWS::IAM::ManagedPolicy", {"Properties": {"Roles": [lambda_role]}}
+    )
+    assert len(policies) == 1
+    (policy,) = policies.values()
+    document = policy["Properties"]["PolicyDocument"]
+    assert document["Version"] == "2012-10-17"
+    statements = document["Statement"]
+    assert [statement["Action"] for statement in statements] == expected_actions
+    assert all(statement["Effect"] == "Allow" for statement in statements)
+    # The findings are only read from the detectors of the stack account and region
+    assert statements[2]["Resource"] == {
+        "Fn::Join": ["", ["arn:aws:guardduty:us-east-1:", {"Ref": "AWS::AccountId"}, ":detector/*"]]
+    }
+    # guardduty:ListDetectors and the Detective list actions do not support resource level
+    # permissions
+    assert statements[3]["Resource"] == "*"
+    # The inference profile and the foundation model it routes the requests to
+    assert statements[4]["Resource"] == [
         {
-            "PolicyDocument": expected_policy,
-            "PolicyName": "LambdaExecutionRoleDefaultPolicy6D69732F",
-            "Roles": [{"Ref": "LambdaExecutionRoleD5C26073"}],
+            "Fn::Join": [
+                "",
+                [
+                    "arn:aws:bedrock:us-east-1:",
+                    {"Ref": "AWS::AccountId"},
+                    f":inference-profile/us.{constants.BEDROCK_FOUNDATION_MODEL_ID}",
+                ],
+            ]
         },
+        f"arn:aws:bedrock:*::foundation-model/{constants.BEDROCK_FOUNDATION_MODEL_ID}",
+    ]
+    # Only the iam:PassRole statement is conditional
+    assert [statement.get("Condition") for statement in statements] == [None] * 6 + [
+        {"StringEquals": {"iam:PassedToService": "scheduler.amazonaws.com"}},
+        None,
+    ]
+
+    # The role has no default inline policy, all its grants are authored in the managed policy
+    assert (
+        load_stack.find_resources("AWS::IAM::Policy", {"Properties": {"Roles": [lambda_role]}})
+        == {}
+    )
+
+    # The retry schedules invoke the Lambda function with their own role
+    roles = load_stack.find_resources("AWS::IAM::Role").values()
+    assert any(
+        statement["Principal"] == {"Service": "scheduler.amazonaws.com"}
+        for role in roles
+        for statement in role["Properties"]["AssumeRolePolicyDocument"]["Statement"]
+    )
+
+
+# Test to check if the topic key rotates and lets the Lambda function role encrypt the
+# messages published to the topic
+def test_topic_key_rotation_and_lambda_grant(load_stack):
+    keys = load_stack.find_resources("AWS::KMS::Key")
+    assert len(keys) == 1
+    ((key_id, key),) = keys.items()
+    assert key["Properties"]["EnableKeyRotation"] is True
+    assert {
+        "Action": ["kms:Decrypt", "kms:GenerateDataKey*"],
+        "Effect": "Allow",
+        "Principal": {"AWS": {"Fn::GetAtt": ["LambdaExecutionRoleD5C26073", "Arn"]}},
+        "Resource": "*",
+    } in key["Properties"]["KeyPolicy"]["Statement"]
+    load_stack.has_resource_properties(
+        "AWS::SNS::Topic", {"KmsMasterKeyId": {"Fn::GetAtt": [key_id, "Arn"]}}
     )
 
 
-# Test for EventBridge rescheduling permissions in Lambda IAM policy
-def test_lambda_rescheduling_permissions(load_stack):
+# Test to check if the PDF Lambda function is triggered by the AI insights stored in S3
+def test_pdf_lambda_triggered_by_insights(load_stack):
     load_stack.has_resource_properties(
-        "AWS::IAM::Policy",
+        "AWS::Lambda::Function",
+        # The main Lambda function decides which reports are generated, the PDF function
+        # needs no access to the topic
+        {"Handler": "index.pdf_handler", "Environment": assertions.Match.absent()},
+    )
+    load_stack.has_resource_properties(
+        "Custom::S3BucketNotifications",
         {
-            "PolicyDocument": {
-                "Statement": assertions.Match.array_with(
-                    [
-                        assertions.Match.object_like(
-                            {
-                                "Action": [
-                                    "events:PutRule",
-                                    "events:PutTargets",
-                                    "events:DeleteRule",
-                                    "events:RemoveTargets",
-                                ],
-                                "Effect": "Allow",
-                                "Resource": assertions.Match.any_value(),
-                            }
-                        )
-                    ]
-                )
+            "NotificationConfiguration": {
+                "LambdaFunctionConfigurations": [
+                    assertions.Match.object_like(
+                        {
+                            "Events": ["s3:ObjectCreated:*"],
+                            "Filter": {
+                                "Key": {
+                                    "FilterRules": assertions.Match.array_with(
+                                        [{"Name": "prefix", "Value": "insights/"}]
+                                    )
+                                }
+                            },
+                        }
+                    )
+                ]
             }
         },
     )
-
-
-# Test if KMS key is created with key rotation enabled
-def test_kms_key_with_rotation(load_stack):
-    load_stack.has_resource_properties("AWS::KMS::Key", {"EnableKeyRotation": True})
@@ -0,0 +1,50 @@
+import subprocess
+from unittest import mock
+
+import pytest
+from l3constructs.helpers import helper
+
+
+def git(repository, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=repository,
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.fixture
+def repository(tmp_path):
+    git(tmp_path, "init", "-b", "feature")
+    git(tmp_path, "commit", "--allow-empty", "-m", "initial")
+    return tmp_path
+
+
+def read_branch_name(path, with_pygit2: bool) -> str:
+    helper._read_branch_name.cache_clear()
+    helper._open_repository.cache_clear()
+    if with_pygit2:
+        return helper._read_branch_name(str(path))
+    with mock.patch("l3constructs.helpers.helper._open_repository", return_value=None):
+        return helper._read_branch_name(str(path))
+
+
+# Test to check if the branch is read from the HEAD file when pygit2 is not installed
+def test_read_branch_name_without_pygit2(repository):
+    assert read_branch_name(repository, with_pygit2=False) == "feature"
+
+    git(repository, "checkout", "--detach")
+    assert read_branch_name(repository, with_pygit2=False) == "HEAD"
+
+
+# Test to check if the qualifier does not depend on whether pygit2 is installed
+@pytest.mark.parametrize("detached", [False, True])
+def test_read_branch_name_matches_pygit2(repository, detached):
+    pytest.importorskip("pygit2")
+    if detached:
+        git(repository, "checkout", "--detach")
+
+    assert read_branch_name(repository, with_pygit2=False) == read_branch_name(
+        repository, with_pygit2=True
+    )
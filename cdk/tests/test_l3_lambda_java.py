@@ -0,0 +1,35 @@
+import subprocess
+from unittest import mock
+
+from l3constructs.lambda_functions.L3LambdaJava import MyLocalBundler
+
+FUNCTION_NAME = "test-function"
+
+
+def completed_build(returncode: int = 0) -> subprocess.CompletedProcess:
+    return subprocess.CompletedProcess(args=[], returncode=returncode, stdout="", stderr="")
+
+
+# Test to check if the jar built by Maven is copied into the asset output
+def test_local_bundler_copies_the_built_jar(tmp_path):
+    lambda_root = tmp_path / "lambda"
+    (lambda_root / "target").mkdir(parents=True)
+    (lambda_root / "target" / f"{FUNCTION_NAME}.jar").write_bytes(b"jar")
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+
+    bundler = MyLocalBundler(lambda_root=str(lambda_root), function_name=FUNCTION_NAME)
+    with mock.patch("subprocess.run", return_value=completed_build()) as run:
+        assert bundler.try_bundle(str(output_dir), None)
+
+    assert run.call_args.kwargs["cwd"] == str(lambda_root)
+    assert (output_dir / f"{FUNCTION_NAME}.jar").read_bytes() == b"jar"
+
+
+# Test to check if the docker bundling is used when Maven fails or builds no jar
+def test_local_bundler_fails_without_a_built_jar(tmp_path):
+    bundler = MyLocalBundler(lambda_root=str(tmp_path), function_name=FUNCTION_NAME)
+    with mock.patch("subprocess.run", return_value=completed_build(returncode=1)):
+        assert not bundler.try_bundle(str(tmp_path), None)
+    with mock.patch("subprocess.run", return_value=completed_build()):
+        assert not bundler.try_bundle(str(tmp_path), None)
@@ -0,0 +1,63 @@
+import subprocess
+from pathlib import Path
+from unittest import mock
+
+from aws_cdk import aws_lambda
+from l3constructs.lambda_functions.L3LambdaPython import MyLocalBundler
+
+LAMBDA_CODE_PATH = Path(__file__).resolve().parents[2] / "app" / "ai_generator"
+
+
+def completed_install(returncode: int = 0) -> subprocess.CompletedProcess:
+    return subprocess.CompletedProcess(args=[], returncode=returncode, stdout="", stderr="")
+
+
+# Test to check if the compiled dependencies are installed for the runtime of the Lambda
+# function, not for the interpreter running the synth
+def test_local_bundler_installs_runtime_wheels(tmp_path):
+    bundler = MyLocalBundler(
+        lambda_root=str(LAMBDA_CODE_PATH),
+        app_root="",
+        runtime=aws_lambda.Runtime.PYTHON_3_12,
+        architecture=aws_lambda.Architecture.ARM_64,
+    )
+    with mock.patch("subprocess.run", return_value=completed_install()) as run:
+        assert bundler.try_bundle(str(tmp_path), None)
+
+    (cmd,) = run.call_args.args
+    assert cmd[:6] == [
+        "pip",
+        "install",
+        "-r",
+        str(LAMBDA_CODE_PATH / "requirements.txt"),
+        "-t",
+        str(tmp_path),
+    ]
+    options = cmd[6:]
+    assert options[options.index("--platform") + 1] == "manylinux2014_aarch64"
+    assert options[options.index("--implementation") + 1] == "cp"
+    assert options[options.index("--python-version") + 1] == "3.12"
+    assert "--no-deps" in options and "--prefer-binary" in options
+    assert (tmp_path / "index.py").exists()
+
+
+# Test to check if the docker bundling is used when pip fails
+def test_local_bundler_fails_when_pip_fails(tmp_path):
+    bundler = MyLocalBundler(lambda_root=str(LAMBDA_CODE_PATH), app_root="")
+    with mock.patch("subprocess.run", return_value=completed_install(returncode=1)):
+        assert not bundler.try_bundle(str(tmp_path), None)
+
+    assert not (tmp_path / "index.py").exists()
+
+
+# Test to check if the bundle only holds the function code and its dependencies
+def test_local_bundler_writes_no_bookkeeping_files(tmp_path):
+    bundler = MyLocalBundler(lambda_root=str(LAMBDA_CODE_PATH), app_root="")
+    with mock.patch("subprocess.run", return_value=completed_install()):
+        assert bundler.try_bundle(str(tmp_path), None)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        path.name
+        for path in LAMBDA_CODE_PATH.iterdir()
+        if path.name not in ("__pycache__", ".venv") and path.suffix != ".pyc"
+    )
@@ -1,11 +1,18 @@
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# The S3 purge deletes the object versions in parallel batches, one connection per worker
+MAX_WORKERS = 50
+CONFIG = Config(max_pool_connections=MAX_WORKERS)
+
 qualifier = sys.argv[1]
 stack_name = sys.argv[2]
 # Set default values
@@ -16,21 +23,92 @@ if len(sys.argv) > 4:
     account = sys.argv[3] if sys.argv[3] != "" else None
     region = sys.argv[4] if sys.argv[4] != "" else None
 
-s3 = boto3.resource("s3", region_name=region)
-cloudformation = boto3.resource("cloudformation", region_name=region)
+# The clients are used directly, the resource layer would wrap every object version listed
+s3 = boto3.client("s3", region_name=region, config=CONFIG)
+cloudformation = boto3.client("cloudformation", region_name=region)
 
 account = account if account else boto3.client("sts").get_caller_identity()["Account"]
 region = region if region else boto3.session.Session().region_name
 
-try:
-    logger.info(f"Deleting stack {stack_name} in account {account} and region {region}")
-    stack = cloudformation.Stack(stack_name)
-    stack.delete()
-    logger.info(f"Deleting S3 bucket cdk-{qualifier}-assets-{account}-{region}")
-    bucket = s3.Bucket(f"cdk-{qualifier}-assets-{account}-{region}")
-    bucket.objects.delete()
-    bucket.object_versions.delete()
-    bucket.delete()
+
+def stack_exists(stack_name):
+    """Return whether the CloudFormation stack exists."""
+    try:
+        cloudformation.describe_stacks(StackName=stack_name)
+    except ClientError as error:
+        if "does not exist" in error.response["Error"]["Message"]:
+            return False
+        raise
+    return True
+
+
+def bucket_exists(bucket_name):
+    """Return whether the S3 bucket exists."""
+    try:
+        s3.head_bucket(Bucket=bucket_name)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchBucket"):
+            return False
+        raise
+    return True
+
+
+def wait_for_stack_deletion(stack_name):
+    """Wait until CloudFormation finished deleting the stack."""
+    waiter = cloudformation.get_waiter("stack_delete_complete")
+    waiter.wait(StackName=stack_name)
     logger.info(f"Stack {stack_name} deleted successfully")
-except s3.meta.client.exceptions.NoSuchBucket:
+
+
+def iter_object_versions(bucket_name):
+    """Yield the object versions and delete markers of the bucket, in pages of up to 1000."""
+    paginator = s3.get_paginator("list_object_versions")
+    for page in paginator.paginate(Bucket=bucket_name):
+        objects = [
+            {"Key": version["Key"], "VersionId": version["VersionId"]}
+            for version in page.get("Versions", []) + page.get("DeleteMarkers", [])
+        ]
+        if objects:
+            yield objects
+
+
+def delete_object_versions(bucket_name, objects):
+    """Delete a page of object versions and delete markers in a single request."""
+    response = s3.delete_objects(Bucket=bucket_name, Delete={"Objects": objects, "Quiet": True})
+    for error in response.get("Errors", []):
+        logger.error(f"Could not delete {error['Key']}: {error['Message']}")
+
+
+def purge_bucket(executor, bucket_name):
+    """Delete all the object versions of the bucket, then the bucket itself."""
+    pages = iter_object_versions(bucket_name)
+    # Consume the results so errors raised by the workers are propagated
+    list(executor.map(lambda objects: delete_object_versions(bucket_name, objects), pages))
+    s3.delete_bucket(Bucket=bucket_name)
+    logger.info(f"Bucket {bucket_name} deleted successfully")
+
+
+bucket_name = f"cdk-{qualifier}-assets-{account}-{region}"
+# Repeated cleanup runs find nothing left to delete, so skip the deletions of missing resources
+delete_stack = stack_exists(stack_name)
+delete_bucket = bucket_exists(bucket_name)
+if not delete_stack:
+    logger.info(f"Stack {stack_name} does not exist in account {account} and region {region}")
+if not delete_bucket:
+    logger.info(f"S3 bucket {bucket_name} does not exist")
+
+try:
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        if delete_stack:
+            logger.info(f"Deleting stack {stack_name} in account {account} and region {region}")
+            # The stack deletion runs in CloudFormation, so the bucket is purged in the meantime
+            cloudformation.delete_stack(StackName=stack_name)
+            futures.append(executor.submit(wait_for_stack_deletion, stack_name))
+        if delete_bucket:
+            logger.info(f"Deleting S3 bucket {bucket_name}")
+            futures.append(executor.submit(purge_bucket, executor, bucket_name))
+        for future in futures:
+            future.result()
+except s3.exceptions.NoSuchBucket:
     pass